@@ -18,12 +18,16 @@
 # along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
 
 import anydbm
+import collections
 import ConfigParser
+import copy
 import ipaddress
 import os
 import socket
 import subprocess
 import sys
+import thread
+import time
 
 try:
     import DNS
@@ -45,8 +49,27 @@ mailuid = '2'
 mailgid = '2'
 version = 'unknown'
 
+# The values above are discovered by running courier-config and
+# "courier --version", and saved in setupStateFile so that other
+# processes do not need to run them again.  The saved values are used
+# until either program is replaced.
+setupStateFile = '/var/lib/pythonfilter/courier-config'
 
+# Configuration files that are compiled into memory are checked for
+# changes no more often than this number of seconds.
+configCheckInterval = 5
+
+# The number of recent answers kept in memory for each of the
+# hosteddomains and aliases databases.
+dbmCacheSize = 1000
+
+
+_setupSettings = ('prefix', 'exec_prefix', 'bindir', 'sbindir',
+                  'libexecdir', 'sysconfdir', 'datadir', 'localstatedir',
+                  'mailuser', 'mailgroup', 'mailuid', 'mailgid')
 def _setup():
+    if _loadSetupState():
+        return
     # Get the path layout for Courier.
     try:
         ch = subprocess.Popen('courier-config', stdout=subprocess.PIPE)
@@ -59,9 +82,7 @@ def _setup():
                 value = valueN.strip()
             except:
                 continue
-            if setting in ('prefix', 'exec_prefix', 'bindir', 'sbindir',
-                           'libexecdir', 'sysconfdir', 'datadir', 'localstatedir',
-                           'mailuser', 'mailgroup', 'mailuid', 'mailgid'):
+            if setting in _setupSettings:
                 globals()[setting] = value
         # Catch the exit of courier-config
         try:
@@ -85,9 +106,102 @@ def _setup():
             ch.wait()
         except OSError:
             pass
-    # Initialize the DNS module
-    if DNS:
+    _saveSetupState()
+
+
+def _findProgram(name):
+    for pathDir in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(pathDir, name)
+        if os.access(path, os.X_OK):
+            return path
+    return name
+
+
+def _setupStamps():
+    """Return strings identifying the programs that _setup runs.
+
+    If either string changes, the values saved in setupStateFile are
+    out of date.
+
+    """
+    stamps = []
+    for path in (_findProgram('courier-config'), '%s/courier' % sbindir):
+        try:
+            stamps.append('%s:%d' % (path, os.stat(path).st_mtime))
+        except OSError:
+            stamps.append('%s:missing' % path)
+    return stamps
+
+
+def _loadSetupState():
+    """Load the values saved by _saveSetupState.
+
+    Return True if the values were loaded, or False if the state file
+    could not be read or is out of date.
+
+    """
+    try:
+        stateFile = open(setupStateFile)
+    except IOError:
+        return False
+    try:
+        state = {}
+        for line in stateFile:
+            (setting, sep, value) = line.rstrip('\n').partition('=')
+            if sep:
+                state[setting] = value
+    finally:
+        stateFile.close()
+    if 'sbindir' not in state or 'version' not in state:
+        return False
+    global sbindir
+    savedSbindir = sbindir
+    sbindir = state['sbindir']
+    if _setupStamps() != [state.get('courier-config'), state.get('courier')]:
+        sbindir = savedSbindir
+        return False
+    for setting in _setupSettings + ('version',):
+        if setting in state:
+            globals()[setting] = state[setting]
+    return True
+
+
+def _saveSetupState():
+    """Save the values discovered by _setup in setupStateFile.
+
+    Errors are ignored, since the values can always be discovered
+    again.
+
+    """
+    lines = []
+    for (setting, value) in zip(('courier-config', 'courier'), _setupStamps()):
+        lines.append('%s=%s\n' % (setting, value))
+    for setting in _setupSettings + ('version',):
+        lines.append('%s=%s\n' % (setting, globals()[setting]))
+    tmpPath = '%s.%d' % (setupStateFile, os.getpid())
+    try:
+        stateFile = open(tmpPath, 'w')
+        try:
+            stateFile.write(''.join(lines))
+        finally:
+            stateFile.close()
+        os.rename(tmpPath, setupStateFile)
+    except (IOError, OSError):
+        try: os.unlink(tmpPath)
+        except OSError: pass
+
+
+def initDNS(_done = [False]):
+    """Find the system's name servers for the DNS module.
+
+    This is done only once.  Functions in this module call initDNS
+    before they use the DNS module, and pythonfilter calls it at
+    startup for the benefit of filters that use the DNS module.
+
+    """
+    if DNS and not _done[0]:
         DNS.DiscoverNameServers()
+        _done[0] = True
 
 
 def _openDbm(path):
@@ -105,6 +219,143 @@ def _openDbm(path):
     return dbm
 
 
+_dbmHandles = {}
+_dbmHandlesLock = thread.allocate_lock()
+def _dbmLookup(filename, key, lookupFunction):
+    """Return lookupFunction(dbm, key) for a database in sysconfdir.
+
+    Databases are opened once and kept open until the file is replaced
+    or modified, which is checked at most once every
+    configCheckInterval seconds.  The last dbmCacheSize answers for
+    each database are kept in memory, and discarded when the database
+    is reopened.  If the database does not exist or cannot be opened,
+    None is returned.
+
+    """
+    path = '%s/%s' % (sysconfdir, filename)
+    now = time.time()
+    _dbmHandlesLock.acquire()
+    try:
+        entry = _dbmHandles.get(path)
+        if not entry or now - entry['checked'] >= configCheckInterval:
+            try:
+                st = os.stat(path)
+                fileId = (st.st_ino, st.st_size, st.st_mtime)
+            except OSError:
+                fileId = None
+            if not entry or entry['fileId'] != fileId:
+                if entry and entry['dbm'] is not None:
+                    entry['dbm'].close()
+                dbm = None
+                if fileId is not None:
+                    try:
+                        dbm = _openDbm(path)
+                    except:
+                        pass
+                entry = {'dbm': dbm, 'fileId': fileId,
+                         'cache': collections.OrderedDict()}
+                _dbmHandles[path] = entry
+            entry['checked'] = now
+        if entry['dbm'] is None:
+            return None
+        cache = entry['cache']
+        if key in cache:
+            value = cache.pop(key)
+        else:
+            value = lookupFunction(entry['dbm'], key)
+            if len(cache) >= dbmCacheSize:
+                cache.popitem(last=False)
+        cache[key] = value
+        return value
+    finally:
+        _dbmHandlesLock.release()
+
+
+_compiledFiles = {}
+_compiledFilesLock = thread.allocate_lock()
+def _getCompiledFile(filename, compileFunction):
+    """Return the compiled form of a file in sysconfdir.
+
+    compileFunction is called with the path of the file, and its
+    return value is cached.  It will be called again only when the
+    file's inode, size or modification time changes, and those are
+    checked at most once every configCheckInterval seconds.  If the
+    file does not exist, compileFunction must handle the error.
+
+    """
+    path = '%s/%s' % (sysconfdir, filename)
+    key = (path, compileFunction)
+    now = time.time()
+    _compiledFilesLock.acquire()
+    try:
+        entry = _compiledFiles.get(key)
+        if entry and now - entry[2] < configCheckInterval:
+            return entry[0]
+        try:
+            st = os.stat(path)
+            fileId = (st.st_ino, st.st_size, st.st_mtime)
+        except OSError:
+            fileId = None
+        if entry and entry[1] == fileId:
+            entry[2] = now
+            return entry[0]
+        value = compileFunction(path)
+        _compiledFiles[key] = [value, fileId, now]
+        return value
+    finally:
+        _compiledFilesLock.release()
+
+
+def _compileFirstLine(path):
+    try:
+        cfile = open(path, 'r')
+    except IOError:
+        return None
+    try:
+        return cfile.readline().strip()
+    finally:
+        cfile.close()
+
+
+def _compileExists(path):
+    return os.access(path, os.F_OK)
+
+
+def _compileLocals(path):
+    """Compile the locals file into a pair of dictionaries.
+
+    The first maps each domain listed in the file, or excluded with a
+    "!" prefix, to the tuple (lineNumber, isLocal).  The second maps
+    each ".domain" wildcard to the tuple (lineNumber, True).  Line
+    numbers are kept so that the first matching line wins, as it does
+    when the file is read by Courier.
+
+    """
+    try:
+        locals_ = open(path)
+    except IOError:
+        return None
+    exact = {}
+    wildcards = {}
+    try:
+        lineNumber = 0
+        for line in locals_:
+            lineNumber += 1
+            line = line.strip()
+            if not line or line[0] == '#':
+                continue
+            if line[0] == '!':
+                exact.setdefault(line[1:], (lineNumber, False))
+            elif line[0] == '.':
+                wildcards.setdefault(line, (lineNumber, True))
+                exact.setdefault(line, (lineNumber, True))
+            else:
+                exact.setdefault(line, (lineNumber, True))
+    finally:
+        locals_.close()
+    return (exact, wildcards)
+
+
 def isMinVersion(minVersion):
     """Check for minimum version of Courier.
 
@@ -120,11 +371,7 @@ def isMinVersion(minVersion):
 
 
 def read1line(filename):
-    try:
-        cfile = open(sysconfdir + '/' + filename, 'r')
-    except IOError:
-        return None
-    return cfile.readline().strip()
+    return _getCompiledFile(filename, _compileFirstLine)
 
 
 def me(_cached = [None]):
@@ -162,6 +409,7 @@ def esmtphelo(connection=None):
         if connection is None or DNS is None:
             val = me()
         else:
+            initDNS()
             val = DNS.revlookup(connection.getsockname()[0])
     return val
 
@@ -199,9 +447,29 @@ def dsnfrom(_cached = [None]):
     return '"Courier mail server at %s" <@>' % me()
 
 
+def batchsize(_cached = [None]):
+    """Return Courier's "batchsize" value.
+
+    This is the maximum number of recipients in a single control file.
+    Call this function with no arguments.
+
+    """
+    if _cached[0]:
+        return _cached[0]
+    val = read1line('batchsize')
+    try:
+        val = int(val)
+    except (TypeError, ValueError):
+        val = 0
+    if val <= 0:
+        val = 100
+    _cached[0] = val
+    return val
+
+
 def locallowercase():
     """Return True if the locallowercase file exists, and False otherwise."""
-    if os.access('%s/locallowercase' % sysconfdir, os.F_OK):
+    if _getCompiledFile('locallowercase', _compileExists):
         return 1
     return 0
 
@@ -212,22 +480,23 @@ def isLocal(domain):
     See the courier(8) man page for more information on local domains.
 
     """
-    try:
-        locals_ = open('%s/locals' % sysconfdir)
-    except IOError:
+    compiledLocals = _getCompiledFile('locals', _compileLocals)
+    if compiledLocals is None:
         if domain == me():
             return 1
         return 0
-    for line in locals_.readlines():
-        if line[0] in '#\n':
-            continue
-        line = line.strip()
-        if line[0] == '!' and line[1:] == domain:
-            return 0
-        if line[0] == '.' and domain.endswith(line):
-            return 1
-        if line == domain:
-            return 1
+    (exact, wildcards) = compiledLocals
+    match = exact.get(domain)
+    # Check each wildcard that could match the domain, and keep the
+    # one that appears first in the file.
+    dot = domain.find('.', 1)
+    while dot != -1:
+        wildcard = wildcards.get(domain[dot:])
+        if wildcard and (match is None or wildcard[0] < match[0]):
+            match = wildcard
+        dot = domain.find('.', dot + 1)
+    if match and match[1]:
+        return 1
     return 0
 
 
@@ -237,10 +506,12 @@ def isHosteddomain(domain):
     See the courier(8) man page for more information on hosted domains.
 
     """
-    try:
-        hosteddomains = _openDbm('%s/hosteddomains.dat' % sysconfdir)
-    except:
-        return 0
+    if _dbmLookup('hosteddomains.dat', domain, _lookupHosteddomain):
+        return 1
+    return 0
+
+
+def _lookupHosteddomain(hosteddomains, domain):
     if domain in hosteddomains:
         return 1
     parts = domain.split('.')
@@ -264,45 +535,87 @@ def getAlias(address):
             address = '%s@%s' % (address[:atIndex], me())
     else:
         address = '%s@%s' % (address, me())
-    try:
-        aliases = _openDbm('%s/aliases.dat' % sysconfdir)
-    except:
+    expansion = _dbmLookup('aliases.dat', address, _lookupAlias)
+    if expansion is None:
         return None
+    return expansion[:]
+
+
+def _lookupAlias(aliases, address):
     if address in aliases:
         return aliases[address].strip().split('\n')
     return None
 
 
-def smtpaccess(ip):
-    """ Return the courier smtpaccess value associated with the IP address."""
+def _compileSmtpaccess(path):
+    """Load the smtpaccess database into a pair of prefix trees.
+
+    The first tree holds IPv4 entries, keyed by octet, and the second
+    holds IPv6 entries, keyed by hextet.  Each node is a list holding
+    the entry for that prefix, or None, and a dictionary of child
+    nodes.  An entry is a tuple of the value in the database and a
+    dictionary of the KEY=value attributes parsed from it.
+
+    """
+    try:
+        smtpdb = _openDbm(path)
+    except:
+        return None
+    trees = ([None, {}], [None, {}])
+    try:
+        for key in smtpdb.keys():
+            if key.startswith(':'):
+                node = trees[1]
+                parts = key[1:].split(':')
+            else:
+                node = trees[0]
+                parts = key.split('.')
+            for part in parts:
+                node = node[1].setdefault(part, [None, {}])
+            dbval = smtpdb[key]
+            attributes = {}
+            for val in dbval.split(','):
+                (name, sep, value) = val.partition('=')
+                attributes.setdefault(name, value)
+            node[0] = (dbval, attributes)
+    finally:
+        smtpdb.close()
+    return trees
+
+
+def _smtpaccessEntry(ip):
+    """Return the most specific smtpaccess entry for the IP address."""
     # First break the IP address into parts, either IPv4 or IPv6
     if '.' in  ip:
-        ipsep = '.'
+        treeIndex = 0
+        parts = ip.split('.')
     elif ':' in ip:
-        ipsep = ':'
-        ip = ipaddress.ip_address(unicode(ip)).exploded
+        treeIndex = 1
+        parts = ipaddress.ip_address(unicode(ip)).exploded.split(':')
     else:
         sys.stderr.write('Couldn\'t break %s into parts\n' % ip)
         return None
-    # Next, open the smtpaccess database for ip lookups
-    try:
-        smtpdb = _openDbm(sysconfdir + '/smtpaccess.dat')
-    except:
+    trees = _getCompiledFile('smtpaccess.dat', _compileSmtpaccess)
+    if trees is None:
         return None
-    # Search for a match, most specific to least, and return the
-    # first match.
-    while ip:
-        if ipsep == '.' and ip in smtpdb:
-            return smtpdb[ip]
-        elif ipsep == ':' and (':' + ip) in smtpdb:
-            return smtpdb[':' + ip]
-        # if the ip doesn't match yet, strip off another part
-        try:
-            ri = ip.rindex(ipsep)
-            ip = ip[:ri]
-        except:
-            # separator wasn't found, we don't need to search any more
-            return None
+    # Search for the longest prefix with an entry.
+    node = trees[treeIndex]
+    entry = None
+    for part in parts:
+        node = node[1].get(part)
+        if node is None:
+            break
+        if node[0] is not None:
+            entry = node[0]
+    return entry
+
+
+def smtpaccess(ip):
+    """ Return the courier smtpaccess value associated with the IP address."""
+    entry = _smtpaccessEntry(ip)
+    if entry is None:
+        return None
+    return entry[0]
 
 
 def getSmtpaccessVal(key, ip):
@@ -318,20 +631,10 @@ def getSmtpaccessVal(key, ip):
     Otherwise, the value returned will be a string.
 
     """
-    dbval = smtpaccess(ip)
-    if dbval is None:
+    entry = _smtpaccessEntry(ip)
+    if entry is None:
         return None
-    keyeqlen = len(key) + 1
-    keyeq = key + '='
-    dbvals = dbval.split(',')
-    for val in dbvals:
-        if val == key:
-            # This item in the db matches the key, but has no
-            # associated value.
-            return ''
-        if val.startswith(keyeq):
-            val = val[keyeqlen:]
-            return val
+    return entry[1].get(key)
 
 
 def isRelayed(ip):
@@ -388,25 +691,92 @@ def getModuleConfig(moduleName):
     eval(), so they must be valid python expressions.  They will be
     returned to the caller in their evaluated form.
 
+    The files are parsed, and each section's values evaluated, only
+    once.  They are parsed again when they change, which is checked at
+    most once every configCheckInterval seconds, or after
+    invalidateModuleConfig is called.  Each caller receives its own
+    copy of the values.
+
+    """
+    sections = _loadModuleConfig()
+    _moduleConfigLock.acquire()
+    try:
+        if moduleName not in sections['evaluated']:
+            config = {}
+            for i in sections['raw'].get(moduleName, ()):
+                # eval the value of this item in a new environment to
+                # avoid unpredictable side effects to this modules
+                # namespace
+                value = eval(i[1], {})
+                config[i[0]] = value
+            sections['evaluated'][moduleName] = config
+        return copy.deepcopy(sections['evaluated'][moduleName])
+    finally:
+        _moduleConfigLock.release()
+
+
+_moduleConfig = {}
+_moduleConfigLock = thread.allocate_lock()
+def _loadModuleConfig():
+    """Return the parsed sections of the module configuration files.
+
+    The return value is a dictionary.  Its 'raw' member maps each
+    section name to the list of its (name, value) items, and its
+    'evaluated' member caches the results of getModuleConfig.
+
+    """
+    paths = _standardConfigPaths
+    if isinstance(paths, basestring):
+        paths = [paths]
+    now = time.time()
+    _moduleConfigLock.acquire()
+    try:
+        if(_moduleConfig
+           and _moduleConfig['paths'] == paths
+           and now - _moduleConfig['checked'] < configCheckInterval):
+            return _moduleConfig['sections']
+        fileIds = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                fileIds.append((st.st_ino, st.st_size, st.st_mtime))
+            except OSError:
+                fileIds.append(None)
+        if(_moduleConfig
+           and _moduleConfig['paths'] == paths
+           and _moduleConfig['fileIds'] == fileIds):
+            _moduleConfig['checked'] = now
+            return _moduleConfig['sections']
+        sections = {'raw': {}, 'evaluated': {}}
+        cp = ConfigParser.RawConfigParser()
+        cp.optionxform = str
+        try:
+            cp.read(paths)
+            for section in cp.sections():
+                sections['raw'][section] = cp.items(section)
+        except Exception, e:
+            sys.stderr.write('error parsing module config files: %s, exception: %s\n' %
+                             (paths, str(e)))
+        _moduleConfig.update({'paths': paths[:], 'fileIds': fileIds,
+                              'checked': now, 'sections': sections})
+        return sections
+    finally:
+        _moduleConfigLock.release()
+
+
+def invalidateModuleConfig():
+    """Discard the cached contents of the module configuration files.
+
+    The files will be read again the next time that getModuleConfig
+    is called.  pythonfilter calls this function when it receives
+    SIGHUP.
+
     """
-    config = {}
-    cp = ConfigParser.RawConfigParser()
-    cp.optionxform = str
+    _moduleConfigLock.acquire()
     try:
-        cp.read(_standardConfigPaths)
-        ci = cp.items(moduleName)
-    except ConfigParser.NoSectionError:
-        ci = {}
-    except Exception, e:
-        sys.stderr.write('error parsing config module: %s, exception: %s\n' % (moduleName, str(e)))
-        ci = {}
-    for i in ci:
-        # eval the value of this item in a new environment to
-        # avoid unpredictable side effects to this modules
-        # namespace
-        value = eval(i[1], {})
-        config[i[0]] = value
-    return config
+        _moduleConfig.clear()
+    finally:
+        _moduleConfigLock.release()
 
 
 def applyModuleConfig(moduleName, moduleNamespace):
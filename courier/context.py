@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# courier.context -- python module for sharing message data between filters
+# Copyright (C) 2008  Gordon Messmer <gordon@dragonsdawn.net>
+#
+# This file is part of pythonfilter.
+#
+# pythonfilter is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pythonfilter is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
+
+import thread
+import courier.control
+import courier.headers
+
+
+class MessageContext(object):
+    """Information about a message, read once and shared by filters.
+
+    Arguments:
+    bodyFile -- the same argument given to the doFilter function
+    controlFileList -- the same argument given to the doFilter function
+
+    pythonfilter creates one MessageContext for each message, and
+    gives it to each filter whose doFilter function accepts a third
+    argument.  The control files are parsed once, the first time that
+    any value from them is requested, and the message headers are read
+    once, when they are first requested.  Both are cached for the
+    filters that follow.
+
+    Values are returned as copies, so filters may modify them without
+    affecting other filters.  If a filter modifies the message or its
+    control files, pythonfilter will call the invalidate method before
+    running the next filter.
+
+    """
+    def __init__(self, bodyFile, controlFileList):
+        self.bodyFile = bodyFile
+        self.controlFileList = controlFileList
+        self._cache = {}
+        # Read-only filters may share a context in several threads.
+        self._cacheLock = thread.allocate_lock()
+
+    def _get(self, name, function, *args):
+        self._cacheLock.acquire()
+        try:
+            if name not in self._cache:
+                self._cache[name] = function(*args)
+            return self._cache[name]
+        finally:
+            self._cacheLock.release()
+
+    def invalidate(self):
+        """Discard all cached values."""
+        self._cacheLock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._cacheLock.release()
+
+    def _controlFiles(self):
+        return self._get('controlFiles', courier.control._readControlFiles,
+                         self.controlFileList)
+
+    def _getFirstLine(self, key):
+        for cf in self._controlFiles():
+            lines = cf.getLines(key)
+            if lines:
+                return lines[0]
+        return None
+
+    def getSender(self):
+        """Return the envelope sender."""
+        return self._getFirstLine('s')
+
+    def getSendersMta(self):
+        """Return the "Received-From-MTA" record."""
+        return self._getFirstLine('f')
+
+    def getSendersIP(self):
+        """Return an IP address if one is found in the "Received-From-MTA" record."""
+        return self._get('sendersIP', courier.control._getIPFromMta,
+                         self.getSendersMta())
+
+    def getRecipients(self):
+        """Return a list of message recipients."""
+        return [x.address for x in
+                courier.control._undeliveredRecipients(self._controlFiles())]
+
+    def getRecipientsData(self):
+        """Return a list of Recipient objects describing message recipients.
+
+        See courier.control.getRecipientsData for a description of the
+        values in each Recipient.
+
+        """
+        recipientsData = courier.control._undeliveredRecipients(self._controlFiles())
+        return [x.copy() for x in recipientsData]
+
+    def getAuthUser(self):
+        """Return the username used during SMTP AUTH, if available."""
+        try:
+            messageHeaders = self.getHeaders()
+        except IOError:
+            return None
+        return self._get('authUser', courier.control._getAuthUserFromHeaders,
+                         messageHeaders)
+
+    def getHeaders(self):
+        """Return a courier.headers.Headers object for the message.
+
+        The message body will not be read.  The object is shared by
+        all filters.  IOError is raised if the message cannot be read.
+
+        """
+        return self._get('headers', courier.headers.readHeaders,
+                         self.bodyFile)
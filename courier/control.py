@@ -18,12 +18,187 @@
 # along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
 
 import config
+import errno
+import headers
 import ipaddress
+import mmap
+import os
 import re
 import string
 import time
 
 
+# The maximum number of recipients that addRecipientsData will put in
+# a single control file.  If this is None, Courier's "batchsize"
+# setting is used.
+maxRecipientsPerFile = None
+
+# Control files and message bodies larger than this number of bytes
+# are searched through a memory map, rather than read into memory.
+mmapThreshold = 1048576
+
+
+class Recipient(object):
+    """A message recipient, as recorded in a control file.
+
+    Arguments and attributes:
+    address -- the rewritten address
+    original -- the "original message recipient", as defined by RFC1891
+    dsn -- zero or more characters indicating DSN behavior
+    seq -- the number of this recipient in its control file
+    delivered -- True if delivery is complete for this recipient
+
+    Recipients also behave like the lists that getRecipientsData
+    returned in earlier versions of this module, with the address,
+    original recipient and DSN flags at indexes 0, 1 and 2.  They can
+    be indexed, sliced, modified, iterated and compared to such lists.
+    Slicing returns a list.
+
+    """
+    __slots__ = ('address', 'original', 'dsn', 'seq', 'delivered')
+    _fields = ('address', 'original', 'dsn')
+
+    def __init__(self, address='', original='', dsn='', seq=None, delivered=False):
+        self.address = address
+        self.original = original
+        self.dsn = dsn
+        self.seq = seq
+        self.delivered = delivered
+
+    def _values(self):
+        return [self.address, self.original, self.dsn]
+
+    def copy(self):
+        """Return a new Recipient with the same values."""
+        return Recipient(self.address, self.original, self.dsn,
+                         self.seq, self.delivered)
+
+    def __len__(self):
+        return 3
+
+    def __iter__(self):
+        return iter(self._values())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._values()[index]
+        return getattr(self, self._fields[index])
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            values = self._values()
+            values[index] = value
+            if len(values) != 3:
+                raise ValueError('Recipient must contain 3 values.')
+            (self.address, self.original, self.dsn) = values
+        else:
+            setattr(self, self._fields[index], value)
+
+    def __eq__(self, other):
+        if isinstance(other, (Recipient, list)):
+            return self._values() == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, (Recipient, list)):
+            return self._values() != list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._values())
+
+
+class ControlFile(object):
+    """The contents of a single control file, read in one pass.
+
+    Arguments:
+    path -- the path of the control file
+
+    Attributes:
+    path -- the path of the control file
+    records -- a dictionary mapping each record key found in the file
+        to a list of the values of those records, in the order in
+        which they appear.  The values are stripped of the key and of
+        surrounding whitespace.
+    recipients -- a list of Recipient objects for the recipients in
+        the file, in order.  Recipients are numbered by their order in
+        the file, which is the number used by the "S", "F" and "I"
+        records.
+    addresses -- a dictionary mapping each address to the list of
+        Recipient objects with that address, in order.
+
+    See the "Control Records" section of Courier's Mail Queue
+    documentation for a list of valid control record keys.
+
+    """
+    __slots__ = ('path', 'records', 'recipients', 'addresses')
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self.recipients = []
+        self.addresses = {}
+        cfo = open(path)
+        try:
+            data = cfo.read()
+        finally:
+            cfo.close()
+        self._parse(data)
+
+    def _parse(self, data):
+        records = self.records
+        recipients = self.recipients
+        addresses = self.addresses
+        r = ['', '', ''] # This list will contain the recipient data.
+        for ctlLine in data.split('\n'):
+            if not ctlLine:
+                continue
+            key = ctlLine[0]
+            value = ctlLine[1:].strip()
+            if key in records:
+                records[key].append(value)
+            else:
+                records[key] = [value]
+            if key == 'r':
+                r[0] = value
+            elif key == 'R':
+                r[1] = value
+            elif key == 'N':
+                r[2] = value
+                # This completes a new record, add it to the recipient
+                # data list.
+                if r[0]:
+                    recipient = Recipient(r[0], r[1], r[2], len(recipients))
+                    recipients.append(recipient)
+                    if r[0] in addresses:
+                        addresses[r[0]].append(recipient)
+                    else:
+                        addresses[r[0]] = [recipient]
+                r = ['', '', '']
+            elif key == 'S' or key == 'F':
+                # Control file records either a successful or failed
+                # delivery.  Either way, mark this recipient completed.
+                rnum = int(value.split(' ', 1)[0])
+                recipients[rnum].delivered = True
+
+    def findRecipient(self, address):
+        """Return the first undelivered Recipient with address, or None."""
+        for recipient in self.addresses.get(address, ()):
+            if not recipient.delivered:
+                return recipient
+        return None
+
+    def getLines(self, key):
+        """Return a list of values of the records matching key."""
+        return self.records.get(key, [])
+
+
+def _readControlFiles(controlFileList):
+    return [ControlFile(cf) for cf in controlFileList]
+
+
 def getLines(controlFileList, key, maxLines=0):
     """Return a list of values in the controlFileList matching key.
 
@@ -38,16 +213,57 @@ def getLines(controlFileList, key, maxLines=0):
     """
     lines = []
     for cf in controlFileList:
-        cfo = open(cf)
-        ctlLine = cfo.readline()
-        while ctlLine:
-            if ctlLine[0] == key:
-                lines.append(ctlLine[1:].strip())
-                if maxLines and len(lines) == maxLines:
-                    break
-            ctlLine = cfo.readline()
-        if maxLines and len(lines) == maxLines:
-            break
+        if os.path.getsize(cf) > mmapThreshold:
+            lines.extend(_scanLines(cf, key, maxLines and maxLines - len(lines)))
+        else:
+            lines.extend(ControlFile(cf).getLines(key))
+        if maxLines and len(lines) >= maxLines:
+            return lines[:maxLines]
+    return lines
+
+
+def _openMmap(path):
+    """Return a read-only memory map of the file at path."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+
+def _findLineStart(fileMap, prefix, start=0, end=None):
+    """Return the offset of the next line that begins with prefix, or -1."""
+    if end is None:
+        end = len(fileMap)
+    if start == 0 and fileMap[:len(prefix)] == prefix:
+        return 0
+    pos = fileMap.find('\n' + prefix, max(start - 1, 0), end)
+    if pos == -1:
+        return -1
+    return pos + 1
+
+
+def _scanLines(controlFile, key, maxLines=0):
+    """Return the values of the records in controlFile matching key.
+
+    The file is searched through a memory map, so that only the
+    matching records are copied into strings.
+
+    """
+    lines = []
+    fileMap = _openMmap(controlFile)
+    try:
+        pos = _findLineStart(fileMap, key)
+        while pos != -1:
+            lineEnd = fileMap.find('\n', pos)
+            if lineEnd == -1:
+                lineEnd = len(fileMap)
+            lines.append(fileMap[pos+1:lineEnd].strip())
+            if maxLines and len(lines) >= maxLines:
+                break
+            pos = _findLineStart(fileMap, key, lineEnd + 1)
+    finally:
+        fileMap.close()
     return lines
 
 
@@ -67,7 +283,10 @@ def getSendersMta(controlFileList):
 
 def getSendersIP(controlFileList):
     """Return an IP address if one is found in the "Received-From-MTA" record."""
-    sender = getSendersMta(controlFileList)
+    return _getIPFromMta(getSendersMta(controlFileList))
+
+
+def _getIPFromMta(sender):
     if not sender:
         return None
     ipstr = sender.partition('[')[2].partition(']')[0]
@@ -100,20 +319,23 @@ def getRecipients(controlFileList):
 
 
 def getRecipientsData(controlFileList):
-    """Return a list of lists with details about message recipients.
+    """Return a list of Recipient objects describing message recipients.
 
-    Each list in the list returned will have the following elements:
+    Each Recipient behaves like a list with the following elements:
     0: The rewritten address
     1: The "original message recipient", as defined by RFC1891
     2: Zero or more characters indicating DSN behavior.
 
     """
+    return _undeliveredRecipients(_readControlFiles(controlFileList))
+
+
+def _undeliveredRecipients(controlFiles):
     recipientsData = []
-    for cf in controlFileList:
-        rcpts = _getRecipientsFromFile(cf)
-        for x in rcpts:
-            if x[1] is False:
-                recipientsData.append(x[2])
+    for cf in controlFiles:
+        for x in cf.recipients:
+            if not x.delivered:
+                recipientsData.append(x)
     return recipientsData
 
 
@@ -123,40 +345,15 @@ def _getRecipientsFromFile(controlFile):
     Each list in the list returned will have the following elements:
     0: The sequence number of this recipient
     1: Delivery status as either True (delivered) or False (not delivered)
-    2: A list containing the following elements, describing this recipient:
+    2: A Recipient object describing this recipient, which behaves
+       like a list of the following elements:
         0: The rewritten address
         1: The "original message recipient", as defined by RFC1891
         2: Zero or more characters indicating DSN behavior.
 
     """
-
-    def _addr(recipients, r):
-        if r and r[0]:
-            x = [len(recipients), False, r]
-            recipients.append(x)
-
-    cfo = open(controlFile)
-    recipients = []
-    r = ['', '', ''] # This list will contain the recipient data.
-    ctlLine = cfo.readline()
-    while ctlLine:
-        if ctlLine[0] == 'r':
-            r[0] = ctlLine[1:].strip()
-        if ctlLine[0] == 'R':
-            r[1] = ctlLine[1:].strip()
-        if ctlLine[0] == 'N':
-            r[2] = ctlLine[1:].strip()
-            # This completes a new record, add it to the recipient data list.
-            _addr(recipients, r)
-            r = ['', '', '']
-        if ctlLine[0] == 'S' or ctlLine[0] == 'F':
-            # Control file records either a successful or failed
-            # delivery.  Either way, mark this recipient completed.
-            rnum = ctlLine.split(' ', 1)[0]
-            rnum = int(rnum[1:])
-            recipients[rnum][1] = True
-        ctlLine = cfo.readline()
-    return recipients
+    return [[x.seq, x.delivered, x]
+            for x in ControlFile(controlFile).recipients]
 
 
 def getControlData(controlFileList):
@@ -186,26 +383,15 @@ def getControlData(controlFileList):
             'U': '',
             'u': None,
             'r': []}
-    for cf in controlFileList:
-        cfo = open(cf)
-        ctlLine = cfo.readline()
-        while ctlLine:
-            if ctlLine[0] == 's':
-                data['s'] = ctlLine[1:].strip()
-            if ctlLine[0] == 'f':
-                data['f'] = ctlLine[1:].strip()
-            if ctlLine[0] == 'e':
-                data['e'] = ctlLine[1:].strip()
-            if ctlLine[0] == 't':
-                data['t'] = ctlLine[1:].strip()
-            if ctlLine[0] == 'V':
-                data['V'] = 'V'
-            if ctlLine[0] == 'U':
-                data['U'] = ctlLine[1:].strip()
-            if ctlLine[0] == 'u':
-                data['u'] = ctlLine[1:].strip()
-            ctlLine = cfo.readline()
-    data['r'] = getRecipientsData(controlFileList)
+    controlFiles = _readControlFiles(controlFileList)
+    for cf in controlFiles:
+        for key in ('s', 'f', 'e', 't', 'U', 'u'):
+            values = cf.getLines(key)
+            if values:
+                data[key] = values[-1]
+        if cf.getLines('V'):
+            data['V'] = 'V'
+    data['r'] = _undeliveredRecipients(controlFiles)
     return data
 
 
@@ -225,31 +411,115 @@ def addRecipientData(controlFileList, recipientData):
 
     The recipientData argument must contain the same information that
     is normally returned by the getRecipientsData function for each
-    recipient.  Recipients should be added one at a time.
+    recipient.  To add several recipients, use addRecipientsData.
 
     """
-    # FIXME:  How strict is courier about its upper limit of
-    # recipients per control file?  It's easiest to append the
-    # recipient to the last control file, but it would be more
-    # robust to check the number of recipients in it first and
-    # create a new file if necessary.
-    if len(recipientData) != 3:
-        raise ValueError('recipientData must be a list of 3 values.')
-    cf = controlFileList[-1]
-    cfo = open(cf, 'a')
-    cfo.write('r%s\n' % recipientData[0])
-    cfo.write('R%s\n' % recipientData[1])
-    cfo.write('N%s\n' % recipientData[2])
-    cfo.close()
+    addRecipientsData(controlFileList, [recipientData])
+
 
+def addRecipientsData(controlFileList, recipientsData):
+    """Add a list of recipients to a controlFileList set.
 
-def _markComplete(controlFile, recipientIndex):
-    """Mark a single recipient's delivery as completed."""
+    Each element of the recipientsData argument must contain the same
+    information that is normally returned by the getRecipientsData
+    function for each recipient.  The records are appended to the last
+    control file in a single write.  If that would put more recipients
+    in the file than maxRecipientsPerFile allows, additional control
+    files will be created for the remaining recipients, and their names
+    will be appended to controlFileList.
+
+    """
+    records = []
+    for recipientData in recipientsData:
+        if len(recipientData) != 3:
+            raise ValueError('recipientData must be a list of 3 values.')
+        records.append('r%s\nR%s\nN%s\n' % tuple(recipientData))
+    if not records:
+        return
+    limit = maxRecipientsPerFile or config.batchsize()
+    cf = controlFileList[-1]
+    room = limit - len(ControlFile(cf).recipients)
+    while records:
+        if room <= 0:
+            cf = _newControlFile(controlFileList)
+            room = limit
+        cfo = open(cf, 'a')
+        try:
+            cfo.write(''.join(records[:room]))
+        finally:
+            cfo.close()
+        records = records[room:]
+        room = 0
+
+
+def _newControlFile(controlFileList):
+    """Create an empty control file and add it to controlFileList.
+
+    Courier names the additional control files for a message by
+    appending a number to the name of the first one.
+
+    """
+    mode = os.stat(controlFileList[0]).st_mode & 0777
+    fileNum = len(controlFileList)
+    while True:
+        cf = '%s.%d' % (controlFileList[0], fileNum)
+        try:
+            fd = os.open(cf, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            fileNum += 1
+            continue
+        os.close(fd)
+        controlFileList.append(cf)
+        return cf
+
+
+def _markComplete(controlFile, recipientIndexes):
+    """Mark the delivery of each recipient in recipientIndexes completed."""
+    now = int(time.time())
+    records = []
+    for recipientIndex in recipientIndexes:
+        records.append('I%d R 250 Ok - Removed by courier.control.py\n'
+                       'S%d %d\n' % (recipientIndex, recipientIndex, now))
+    if not records:
+        return
     cfo = open(controlFile, 'a')
-    cfo.seek(0, 2) # Seek to the end of the file
-    cfo.write('I%d R 250 Ok - Removed by courier.control.py\n' %
-              recipientIndex)
-    cfo.write('S%d %d\n' % (recipientIndex, int(time.time())))
+    try:
+        cfo.write(''.join(records))
+    finally:
+        cfo.close()
+
+
+def _delRecipientsMatching(controlFileList, keys, getKey):
+    # Count the number of times each key was requested, so that
+    # each request removes one recipient, as separate calls to
+    # delRecipient or delRecipientData would.  Keys are either
+    # addresses or tuples beginning with an address.
+    pending = {}
+    for key in keys:
+        pending[key] = pending.get(key, 0) + 1
+    for cf in controlFileList:
+        if not pending:
+            return
+        controlFile = ControlFile(cf)
+        completed = []
+        for key in pending.keys():
+            if isinstance(key, tuple):
+                address = key[0]
+            else:
+                address = key
+            for x in controlFile.addresses.get(address, ()):
+                if x.delivered or getKey(x) != key:
+                    continue
+                x.delivered = True
+                completed.append(x.seq)
+                pending[key] -= 1
+                if not pending[key]:
+                    del pending[key]
+                    break
+        completed.sort()
+        _markComplete(cf, completed)
 
 
 def delRecipient(controlFileList, recipient):
@@ -266,13 +536,19 @@ def delRecipient(controlFileList, recipient):
     silently lost.
 
     """
-    for cf in controlFileList:
-        rcpts = _getRecipientsFromFile(cf)
-        for x in rcpts:
-            if(x[1] is False # Delivery is not complete for this recipient
-               and x[2][0] == recipient):
-                _markComplete(cf, x[0])
-                return
+    delRecipients(controlFileList, [recipient])
+
+
+def delRecipients(controlFileList, recipients):
+    """Remove a list of recipients from the list.
+
+    Each element of the recipients arg is a canonical address, which
+    is removed as if it were given to delRecipient.  Each control file
+    is read only once.
+
+    """
+    _delRecipientsMatching(controlFileList, recipients,
+                           lambda recipient: recipient.address)
 
 
 def delRecipientData(controlFileList, recipientData):
@@ -290,15 +566,24 @@ def delRecipientData(controlFileList, recipientData):
     silently lost.
 
     """
-    if len(recipientData) != 3:
-        raise ValueError('recipientData must be a list of 3 values.')
-    for cf in controlFileList:
-        rcpts = _getRecipientsFromFile(cf)
-        for x in rcpts:
-            if(x[1] is False # Delivery is not complete for this recipient
-               and x[2] == recipientData):
-                _markComplete(cf, x[0])
-                return
+    delRecipientsData(controlFileList, [recipientData])
+
+
+def delRecipientsData(controlFileList, recipientsData):
+    """Remove a list of recipients from the list.
+
+    Each element of the recipientsData arg is removed as if it were
+    given to delRecipientData.  Each control file is read only once,
+    and the records marking the recipients complete are appended to
+    it in a single write.
+
+    """
+    keys = []
+    for recipientData in recipientsData:
+        if len(recipientData) != 3:
+            raise ValueError('recipientData must be a list of 3 values.')
+        keys.append(tuple(recipientData))
+    _delRecipientsMatching(controlFileList, keys, tuple)
 
 
 _hostname = config.me()
@@ -344,29 +629,58 @@ def getAuthUser(controlFileList, bodyFile=None):
 
     """
     try:
-        bfStream = open(bodyFile)
+        if os.path.getsize(bodyFile) > mmapThreshold:
+            return _scanAuthUser(bodyFile)
+        messageHeaders = headers.readHeaders(bodyFile)
     except:
         return None
-    header = bfStream.readline()
-    while 1:
-        bf_line = bfStream.readline()
-        if bf_line == '\n' or bf_line == '':
-            # There are no more headers.  Scan the header we've got and quit.
-            auth = _checkHeader(header)
-            break
-        if bf_line[0] in string.whitespace:
-            # This is a continuation line.  Add bf_line to header and loop.
-            header += bf_line
-        else:
-            # This line begins a new header.  Check the previous header and
-            # replace it before looping.
-            auth = _checkHeader(header)
-            if auth is not None:
-                break
-            else:
-                header = bf_line
+    return _getAuthUserFromHeaders(messageHeaders)
+
+
+def _getAuthUserFromHeaders(messageHeaders):
+    """Return the SMTP AUTH user found in a courier.headers.Headers object.
+
+    Only the first "Received" header, which Courier adds, is examined.
+
+    """
+    received = messageHeaders.get('Received')
+    if received is None:
+        return None
+    found = _auth_regex.search(received)
+    if found:
+        return found.group(1)
+    else:
+        return None
+
+
+def _scanAuthUser(bodyFile):
+    """Search the headers of bodyFile for the SMTP AUTH user.
+
+    As in getAuthUser, only the first "Received" header is examined.
+    The file is searched through a memory map, so that only that
+    header is copied into a string.
+
+    """
+    bfMap = _openMmap(bodyFile)
+    try:
+        if bfMap[:1] == '\n':
+            return None
+        headerEnd = bfMap.find('\n\n')
+        if headerEnd == -1:
+            headerEnd = len(bfMap)
+        pos = _findLineStart(bfMap, 'Received:', 0, headerEnd)
+        if pos == -1:
+            return None
+        # Extend the header through its continuation lines.
+        end = bfMap.find('\n', pos, headerEnd)
+        while end != -1 and end + 1 < headerEnd and bfMap[end+1] in string.whitespace:
+            end = bfMap.find('\n', end + 1, headerEnd)
+        if end == -1:
+            end = headerEnd
+        auth = _checkHeader(bfMap[pos:end+1])
+    finally:
+        bfMap.close()
     if auth:
         return auth
     else:
         return None
-
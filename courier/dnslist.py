@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# courier.dnslist -- python module for DNS black and white lists
+# Copyright (C) 2008  Gordon Messmer <gordon@dragonsdawn.net>
+#
+# This file is part of pythonfilter.
+#
+# pythonfilter is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pythonfilter is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
+
+import ipaddress
+import courier.config
+import courier.resolver
+
+
+# Lists answer with addresses in 127.0.0.0/8.  Some of those addresses
+# don't mean that the IP is listed, but that the query was refused,
+# usually because the name server has sent too many queries.  Answers
+# in these networks are ignored.
+errorCodes = ['127.0.0.255', '127.255.255.0/24']
+
+
+def queryName(ip, zone):
+    """Return the name that is looked up to find ip in zone.
+
+    IPv4 addresses are looked up by their reversed octets, and IPv6
+    addresses by their reversed nibbles.
+
+    """
+    reverse = courier.resolver.reverseName(ip)
+    # Remove the in-addr.arpa or ip6.arpa suffix.
+    return '%s.%s' % (reverse.rsplit('.', 2)[0], zone)
+
+
+def prefetchQueries(ip, zones):
+    """Return the (name, qtype) lookups that lookup(ip, zones) will make.
+
+    Filters may return this list from their prefetch functions.
+
+    """
+    if not ip:
+        return []
+    return [(queryName(ip, zone), courier.resolver.A) for zone in zones]
+
+
+def lookup(ip, zones):
+    """Look up ip in each of zones, and return the answers.
+
+    Return a dictionary mapping the name of each zone that lists ip to
+    a list of the addresses that it returned.  Zones that don't list
+    ip, or don't answer, are not included.  All of the zones are
+    queried at the same time, and their answers are cached by
+    courier.resolver for their TTL.
+
+    """
+    if not ip:
+        return {}
+    names = [(zone, queryName(ip, zone)) for zone in zones]
+    courier.resolver.prefetch([(name, courier.resolver.A)
+                               for (zone, name) in names])
+    results = {}
+    for (zone, name) in names:
+        try:
+            answers = courier.resolver.query(name, courier.resolver.A)
+        except courier.resolver.ResolverError:
+            continue
+        answers = [x for x in answers if _isListed(x)]
+        if answers:
+            results[zone] = answers
+    return results
+
+
+def score(ip, zones):
+    """Return the sum of the weights of the lists that include ip.
+
+    zones is a dictionary mapping zone names to weights.  A weight may
+    be a number, which is added to the score if the zone lists ip at
+    all, or a dictionary mapping return codes to numbers.  Return codes
+    may be addresses such as '127.0.0.2' or networks such as
+    '127.0.10.0/24'.  The weight of each code that the zone returns is
+    added to the score.  If zones is a list, each zone has a weight
+    of 1.
+
+    """
+    if not isinstance(zones, dict):
+        zones = dict.fromkeys(zones, 1)
+    total = 0
+    for (zone, answers) in lookup(ip, zones).items():
+        weights = zones[zone]
+        if not isinstance(weights, dict):
+            total += weights
+            continue
+        for answer in answers:
+            total += _codeWeight(weights, answer)
+    return total
+
+
+def _isListed(answer):
+    address = ipaddress.ip_address(unicode(answer))
+    for network in _errorNetworks:
+        if address in network:
+            return False
+    return True
+
+
+def _codeWeight(weights, answer):
+    if answer in weights:
+        return weights[answer]
+    address = ipaddress.ip_address(unicode(answer))
+    for (code, weight) in weights.items():
+        if '/' in code and address in ipaddress.ip_network(unicode(code)):
+            return weight
+    return 0
+
+
+def _setup():
+    global _errorNetworks
+    courier.config.applyModuleConfig('dnslist.py', globals())
+    _errorNetworks = [ipaddress.ip_network(unicode(x)) for x in errorCodes]
+
+
+_setup()
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# courier.headers -- python module for reading message headers
+# Copyright (C) 2008  Gordon Messmer <gordon@dragonsdawn.net>
+#
+# This file is part of pythonfilter.
+#
+# pythonfilter is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pythonfilter is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
+
+import string
+
+
+class Headers(object):
+    """The header block of a message.
+
+    Arguments:
+    headerLines -- a sequence of the lines in the header block,
+        including line endings, not including the blank line that
+        ends the block.
+
+    Headers are unfolded: continuation lines are joined to the header
+    that they continue, and line endings are removed.  Header names
+    are matched without regard to case.
+
+    """
+    def __init__(self, headerLines):
+        self._headers = []
+        self._index = {}
+        name = None
+        value = []
+        for line in headerLines:
+            if line[:1] in string.whitespace:
+                # This is a continuation line.
+                if name is not None:
+                    value.append(line.rstrip('\r\n'))
+                continue
+            if name is not None:
+                self._add(name, value)
+            (name, sep, first) = line.partition(':')
+            if not sep:
+                # This isn't a header.  Skip it.
+                name = None
+                continue
+            value = [first.rstrip('\r\n')]
+        if name is not None:
+            self._add(name, value)
+
+    def _add(self, name, value):
+        name = name.strip()
+        value = ''.join(value).strip()
+        self._headers.append((name, value))
+        key = name.lower()
+        if key in self._index:
+            self._index[key].append(value)
+        else:
+            self._index[key] = [value]
+
+    def get(self, name, default=None):
+        """Return the value of the first header with name, or default."""
+        values = self._index.get(name.lower())
+        if values:
+            return values[0]
+        return default
+
+    def getAll(self, name, default=None):
+        """Return a list of the values of all headers with name.
+
+        If there are no headers with name, default is returned.  If
+        default is None, an empty list is returned.
+
+        """
+        values = self._index.get(name.lower())
+        if values:
+            return values[:]
+        if default is None:
+            return []
+        return default
+
+    def items(self):
+        """Return a list of (name, value) tuples for all headers, in order."""
+        return self._headers[:]
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __contains__(self, name):
+        return name.lower() in self._index
+
+    def __len__(self):
+        return len(self._headers)
+
+
+def readHeaders(bodyFile):
+    """Return a Headers object for the message in bodyFile.
+
+    The file is read only up to the blank line that ends the header
+    block, so the message body is never read.  IOError is raised if
+    the file cannot be opened.
+
+    """
+    bfStream = open(bodyFile)
+    try:
+        headerLines = []
+        for line in bfStream:
+            if line == '\n' or line == '\r\n':
+                break
+            headerLines.append(line)
+    finally:
+        bfStream.close()
+    return Headers(headerLines)
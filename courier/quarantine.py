@@ -19,13 +19,13 @@
 
 import anydbm
 import datetime
-import email
 import fcntl
 import os
 import time
 import cPickle as pickle
 import courier.config
 import courier.control
+import courier.headers
 import courier.sendmail
 import courier.xfilter
 
@@ -141,15 +141,7 @@ def quarantine(bodyFile, controlFileList, explanation):
     days = config['days']
     expiration = datetime.date.fromtimestamp(time.time() + (days * 86400)).strftime('%a %B %d, %Y')
     # Parse the message for its sender and subject:
-    try:
-        bfStream = open(bodyFile)
-    except:
-        raise #InitError('Internal failure opening message data file')
-    try:
-        qmessage = email.message_from_file(bfStream)
-    except Exception, e:
-        # TODO: Handle this error.
-        raise #InitError('Internal failure parsing message data file: %s' % str(e))
+    qmessage = courier.headers.readHeaders(bodyFile)
     qmessageSender = qmessage['from']
     qmessageSubject = qmessage['subject']
     message = """You received a message that was quarantined because:
@@ -178,8 +170,8 @@ Quarantine release address:
            release)
     # Mark recipients complete and send notices.
     controlData = courier.control.getControlData(controlFileList)
+    courier.control.delRecipientsData(controlFileList, controlData['r'])
     for x in controlData['r']:
-        courier.control.delRecipientData(controlFileList, x)
         sendNotice(message, x[0])
 
 
@@ -0,0 +1,778 @@
+#!/usr/bin/python
+# courier.resolver -- python module for caching DNS lookups
+# Copyright (C) 2008  Gordon Messmer <gordon@dragonsdawn.net>
+#
+# This file is part of pythonfilter.
+#
+# pythonfilter is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pythonfilter is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import fcntl
+import ipaddress
+import os
+import random
+import select
+import socket
+import struct
+import sys
+import thread
+import threading
+import time
+import courier.config
+
+try:
+    import spf
+except ImportError:
+    spf = None
+
+
+# Name servers to query.  If this list is empty, the "nameserver"
+# lines in resolvConf will be used.
+nameservers = []
+resolvConf = '/etc/resolv.conf'
+port = 53
+# Each name server will be given "timeout" seconds to reply, and will
+# be tried "attempts" times.
+timeout = 2
+attempts = 2
+# Answers are cached for the TTL given by the name server, but for no
+# longer than maxTtl seconds.  Names that don't exist, and names that
+# don't have records of the requested type, are cached for the TTL
+# given by their zone's SOA record, but for no longer than negativeTtl
+# seconds.
+maxTtl = 86400
+negativeTtl = 300
+maxCacheEntries = 10000
+# Queries are sent from a socket with a port chosen by the kernel.
+# After socketQueries queries, a new socket is used, so that the source
+# port changes as well as the query ID.
+socketQueries = 100
+
+
+A = 1
+NS = 2
+CNAME = 5
+SOA = 6
+PTR = 12
+MX = 15
+TXT = 16
+AAAA = 28
+SPF = 99
+_typeNames = {'A': A, 'NS': NS, 'CNAME': CNAME, 'SOA': SOA, 'PTR': PTR,
+              'MX': MX, 'TXT': TXT, 'AAAA': AAAA, 'SPF': SPF}
+
+_rcodeNxdomain = 3
+
+# Query IDs must not be predictable, or replies could be forged.
+_random = random.SystemRandom()
+
+
+class ResolverError(Exception):
+    pass
+
+
+##############################
+# DNS message format
+##############################
+def _encodeName(name):
+    if isinstance(name, unicode):
+        # The query is built from byte strings.
+        try:
+            name = name.encode('ascii')
+        except UnicodeError:
+            raise ResolverError('Invalid name: %r' % name)
+    name = name.rstrip('.')
+    parts = []
+    if name:
+        for label in name.split('.'):
+            if not label or len(label) > 63:
+                raise ResolverError('Invalid name: %s' % name)
+            parts.append(chr(len(label)) + label)
+    return ''.join(parts) + '\0'
+
+
+def _makeQuery(queryId, name, qtype):
+    """Return a query message requesting recursion."""
+    return (struct.pack('!HHHHHH', queryId, 0x0100, 1, 0, 0, 0) +
+            _encodeName(name) + struct.pack('!HH', qtype, 1))
+
+
+def _decodeName(message, offset):
+    """Return the name at offset, and the offset following it."""
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = ord(message[offset])
+        if length & 0xC0 == 0xC0:
+            # This is a pointer to a name elsewhere in the message.
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 64:
+                raise ResolverError('Name compression loop')
+            offset = struct.unpack('!H', message[offset:offset+2])[0] & 0x3FFF
+        elif length == 0:
+            offset += 1
+            break
+        else:
+            labels.append(message[offset+1:offset+1+length])
+            offset += 1 + length
+    if end is None:
+        end = offset
+    return ('.'.join(labels), end)
+
+
+def _decodeRdata(message, rtype, offset, length):
+    rdata = message[offset:offset+length]
+    if len(rdata) != length:
+        raise ResolverError('Truncated record')
+    if rtype == A:
+        return socket.inet_ntoa(rdata)
+    if rtype == AAAA:
+        return socket.inet_ntop(socket.AF_INET6, rdata)
+    if rtype == MX:
+        return (struct.unpack('!H', rdata[:2])[0],
+                _decodeName(message, offset + 2)[0])
+    if rtype in (CNAME, NS, PTR):
+        return _decodeName(message, offset)[0]
+    if rtype in (TXT, SPF):
+        strings = []
+        pos = 0
+        while pos < length:
+            stringLength = ord(rdata[pos])
+            strings.append(rdata[pos+1:pos+1+stringLength])
+            pos += 1 + stringLength
+        return tuple(strings)
+    if rtype == SOA:
+        (mname, pos) = _decodeName(message, offset)
+        (rname, pos) = _decodeName(message, pos)
+        return (mname, rname) + struct.unpack('!IIIII', message[pos:pos+20])
+    return rdata
+
+
+def _parseReply(message):
+    """Parse a reply message.
+
+    The return value is a dictionary with the members 'id', 'flags',
+    'rcode', 'questions', 'answers' and 'authority'.  Questions are
+    (name, type) tuples and records are (name, type, ttl, value)
+    tuples.  Names are lowercase.
+
+    """
+    try:
+        (queryId, flags, qdcount, ancount, nscount, arcount) = \
+            struct.unpack('!HHHHHH', message[:12])
+        offset = 12
+        questions = []
+        for x in range(qdcount):
+            (qname, offset) = _decodeName(message, offset)
+            (qtype, qclass) = struct.unpack('!HH', message[offset:offset+4])
+            offset += 4
+            questions.append((qname.lower(), qtype))
+        sections = []
+        for count in (ancount, nscount):
+            records = []
+            for x in range(count):
+                (rname, offset) = _decodeName(message, offset)
+                (rtype, rclass, ttl, rdlength) = \
+                    struct.unpack('!HHIH', message[offset:offset+10])
+                offset += 10
+                records.append((rname.lower(), rtype, ttl,
+                                _decodeRdata(message, rtype, offset, rdlength)))
+                offset += rdlength
+            sections.append(records)
+    except (IndexError, ValueError, struct.error, socket.error):
+        # inet_ntoa and inet_ntop reject addresses of the wrong length.
+        raise ResolverError('Malformed reply')
+    return {'id': queryId, 'flags': flags, 'rcode': flags & 0xF,
+            'questions': questions, 'answers': sections[0],
+            'authority': sections[1]}
+
+
+def reverseName(ip):
+    """Return the name used to look up PTR records for an IP address."""
+    address = ipaddress.ip_address(unicode(ip))
+    if address.version == 4:
+        parts = str(address).split('.')
+        parts.reverse()
+        return '%s.in-addr.arpa' % '.'.join(parts)
+    nibbles = list(str(address.exploded).replace(':', ''))
+    nibbles.reverse()
+    return '%s.ip6.arpa' % '.'.join(nibbles)
+
+
+##############################
+# Resolver
+##############################
+class _Outstanding:
+    """A query that has been sent, and is waiting for a reply.
+
+    If callback is given, the receiver thread calls it with the reply,
+    or None if the query times out.  Otherwise, the thread that sent
+    the query waits for the done lock.
+
+    """
+    def __init__(self, server, question, deadline, callback=None):
+        self.sock = None
+        self.server = server
+        self.question = question
+        self.deadline = deadline
+        self.callback = callback
+        self.reply = None
+        # The lock is held until the query is answered or times out.
+        self.done = thread.allocate_lock()
+        self.done.acquire()
+
+    def finish(self, reply):
+        """Deliver reply.  Must be called without the Resolver's lock."""
+        self.reply = reply
+        if self.callback is not None:
+            self.callback(reply)
+        else:
+            self.done.release()
+
+
+class _Pending:
+    """A lookup in progress, which other threads may wait for."""
+    def __init__(self):
+        self.records = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Resolver:
+    """A caching DNS stub resolver.
+
+    Arguments:
+    nameservers -- a list of name server addresses.  If this is empty,
+        the name servers listed in resolvConf are used.
+
+    Queries are sent over one UDP socket for each address family,
+    which is replaced after socketQueries queries, and replies are
+    read by a single thread, so any number of threads may wait for
+    replies at the same time.  A reply is accepted only from the
+    server that was queried, on the socket that sent the query, and
+    only if its ID and question match the query.  If several threads
+    request the same name and type, only one query is sent.  Replies
+    are cached according to their TTL, and negative replies according
+    to the zone's SOA record.
+
+    """
+    def __init__(self, nameservers=None):
+        if not nameservers:
+            nameservers = globals()['nameservers'] or _readResolvConf()
+        self.nameservers = list(nameservers)
+        self._lock = thread.allocate_lock()
+        self._cache = {}
+        self._pending = {}
+        self._outstanding = {}
+        self._sockets = {}
+        self._socketQueries = {}
+        # Replaced sockets are kept until their queries are answered or
+        # time out.
+        self._oldSockets = []
+        self._receiver = None
+        # The receiver thread is woken through this pipe when a new
+        # socket is opened, so that it can read the socket's replies.
+        self._wakeup = None
+        self._pid = os.getpid()
+
+    def query(self, name, qtype):
+        """Return a list of the values of name's records of type qtype.
+
+        qtype may be a number or a name such as 'MX'.  The values are
+        strings for A, AAAA, CNAME, NS and PTR records, (preference,
+        exchange) tuples for MX records, and tuples of strings for TXT
+        records.  If the name does not exist, or has no such records,
+        an empty list is returned.  ResolverError is raised if no name
+        server answers.
+
+        """
+        qtype = _typeNames.get(qtype, qtype)
+        return [x[3] for x in self.queryRecords(name, qtype) if x[1] == qtype]
+
+    def queryRecords(self, name, qtype):
+        """Return all of the records in the answer to a query.
+
+        The return value is a list of (name, type, ttl, value) tuples,
+        which may include CNAME records as well as records of type
+        qtype.
+
+        """
+        key = (name.rstrip('.').lower(), _typeNames.get(qtype, qtype))
+        (records, pending, owner) = self._start(key)
+        if records is not None:
+            return records
+        if owner:
+            self._complete(key, pending)
+        else:
+            pending.done.wait()
+        if pending.error:
+            raise pending.error
+        if pending.records is None:
+            # A prefetch gave up on a reply that it couldn't handle.
+            return self.queryRecords(name, qtype)
+        return pending.records
+
+    def prefetch(self, name, qtype):
+        """Start looking up name's records of type qtype.
+
+        Nothing is done if the answer is cached or is already being
+        looked up.  Otherwise, a query is sent and the caller does not
+        wait for it: the reply is handled by the thread that receives
+        all replies, so prefetching many names doesn't start any new
+        threads.  A thread that queries the same name and type later
+        will use the cached answer, or wait for the lookup to finish.
+        Errors are not reported.
+
+        """
+        key = (name.rstrip('.').lower(), _typeNames.get(qtype, qtype))
+        (records, pending, owner) = self._start(key)
+        if owner:
+            servers = self.nameservers * attempts
+            self._prefetchNext(key, pending, servers, 'No name servers')
+
+    def _prefetchNext(self, key, pending, servers, error):
+        """Send a prefetch query to the first of servers that accepts it."""
+        while servers:
+            server = servers.pop(0)
+            def callback(reply, server=server):
+                self._prefetchReply(key, pending, servers, server, reply)
+            outstanding = _Outstanding(server, key, time.time() + timeout,
+                                       callback)
+            try:
+                self._sendUdp(outstanding)
+                return
+            except (socket.error, ResolverError), e:
+                error = '%s: %s' % (server, e)
+        pending.error = ResolverError('Lookup of %s failed: %s' % (key[0], error))
+        self._finish(key, pending)
+
+    def _prefetchReply(self, key, pending, servers, server, reply):
+        """Handle the reply to a prefetch query, in the receiver thread."""
+        try:
+            if reply is None:
+                error = '%s: timed out' % server
+            elif reply['flags'] & 0x0200:
+                # The reply was truncated.  Leave the lookup to a thread
+                # that queries the name, which can retry over TCP.
+                self._finish(key, pending)
+                return
+            elif reply['rcode'] not in (0, _rcodeNxdomain):
+                error = '%s: response code %d' % (server, reply['rcode'])
+            else:
+                self._store(key, reply)
+                pending.records = reply['answers']
+                self._finish(key, pending)
+                return
+            self._prefetchNext(key, pending, servers, error)
+        except Exception, e:
+            pending.error = e
+            self._finish(key, pending)
+
+    def _start(self, key):
+        """Find a cached answer or a lookup in progress for key.
+
+        Return a (records, pending, owner) tuple.  records is the cached
+        answer, or None.  If there is no cached answer, pending is the
+        _Pending lookup for key, and owner is True if the caller created
+        it and must call _complete.
+
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            cached = self._cache.get(key)
+            if cached and cached[0] > now:
+                return (cached[1], None, False)
+            pending = self._pending.get(key)
+            if pending is not None:
+                return (None, pending, False)
+            pending = _Pending()
+            self._pending[key] = pending
+            return (None, pending, True)
+        finally:
+            self._lock.release()
+
+    def _complete(self, key, pending):
+        try:
+            try:
+                pending.records = self._resolve(key)
+            except Exception, e:
+                pending.error = e
+        finally:
+            self._finish(key, pending)
+
+    def _finish(self, key, pending):
+        self._lock.acquire()
+        try:
+            del self._pending[key]
+        finally:
+            self._lock.release()
+        pending.done.set()
+
+    def clearCache(self):
+        """Discard all cached answers."""
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+    def _resolve(self, key):
+        (name, qtype) = key
+        error = 'No name servers'
+        for attempt in range(attempts):
+            for server in self.nameservers:
+                try:
+                    reply = self._queryUdp(server, name, qtype)
+                    if reply is None:
+                        error = '%s: timed out' % server
+                        continue
+                    if reply['flags'] & 0x0200:
+                        # The reply was truncated.  Retry over TCP.
+                        reply = self._queryTcp(server, name, qtype)
+                except (socket.error, ResolverError), e:
+                    error = '%s: %s' % (server, e)
+                    continue
+                if reply['rcode'] not in (0, _rcodeNxdomain):
+                    error = '%s: response code %d' % (server, reply['rcode'])
+                    continue
+                self._store(key, reply)
+                return reply['answers']
+        raise ResolverError('Lookup of %s failed: %s' % (name, error))
+
+    def _store(self, key, reply):
+        answers = [x for x in reply['answers'] if x[1] == key[1]]
+        if answers:
+            ttl = min([x[2] for x in reply['answers']] + [maxTtl])
+        else:
+            ttl = negativeTtl
+            for record in reply['authority']:
+                if record[1] == SOA:
+                    ttl = min(ttl, record[2], record[3][6])
+        if ttl <= 0:
+            return
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if len(self._cache) >= maxCacheEntries:
+                for cacheKey in self._cache.keys():
+                    if self._cache[cacheKey][0] <= now:
+                        del self._cache[cacheKey]
+                if len(self._cache) >= maxCacheEntries:
+                    self._cache.clear()
+            self._cache[key] = (now + ttl, reply['answers'])
+        finally:
+            self._lock.release()
+
+    def _getSocket(self, family):
+        # Called with self._lock held.
+        if self._pid != os.getpid():
+            # This is a new process, which does not have the parent's
+            # receiver thread.
+            for sock in self._sockets.values() + self._oldSockets:
+                sock.close()
+            self._sockets = {}
+            self._socketQueries = {}
+            self._oldSockets = []
+            self._outstanding = {}
+            self._receiver = None
+            if self._wakeup:
+                os.close(self._wakeup[0])
+                os.close(self._wakeup[1])
+                self._wakeup = None
+            self._pid = os.getpid()
+        if self._socketQueries.get(family, 0) >= socketQueries:
+            self._oldSockets.append(self._sockets.pop(family))
+        if family not in self._sockets:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(0)
+            self._sockets[family] = sock
+            self._socketQueries[family] = 0
+            if self._wakeup:
+                try:
+                    os.write(self._wakeup[1], '\0')
+                except OSError:
+                    # The pipe is full, so the receiver will wake.
+                    pass
+        self._socketQueries[family] += 1
+        if self._receiver is None:
+            self._wakeup = os.pipe()
+            fcntl.fcntl(self._wakeup[1], fcntl.F_SETFL, os.O_NONBLOCK)
+            self._receiver = threading.Thread(target=self._receiveLoop)
+            self._receiver.setDaemon(True)
+            self._receiver.start()
+        return self._sockets[family]
+
+    def _queryUdp(self, server, name, qtype):
+        """Send a query and wait for the reply.
+
+        Return the parsed reply, or None if the server did not reply
+        in time.
+
+        """
+        outstanding = _Outstanding(server, (name, qtype), time.time() + timeout)
+        self._sendUdp(outstanding)
+        # The receiver thread releases the lock when the reply arrives
+        # or the deadline passes.
+        outstanding.done.acquire()
+        return outstanding.reply
+
+    def _sendUdp(self, outstanding):
+        """Send the query described by outstanding to its server."""
+        (server, (name, qtype)) = (outstanding.server, outstanding.question)
+        if ':' in server:
+            family = socket.AF_INET6
+        else:
+            family = socket.AF_INET
+        self._lock.acquire()
+        try:
+            sock = self._getSocket(family)
+            outstanding.sock = sock
+            queryId = _random.randint(0, 65535)
+            while queryId in self._outstanding:
+                queryId = _random.randint(0, 65535)
+            self._outstanding[queryId] = outstanding
+        finally:
+            self._lock.release()
+        try:
+            sock.sendto(_makeQuery(queryId, name, qtype), (server, port))
+        except socket.error:
+            self._lock.acquire()
+            try:
+                del self._outstanding[queryId]
+            finally:
+                self._lock.release()
+            raise
+
+    def _receiveLoop(self):
+        while 1:
+            try:
+                self._receiveOnce()
+            except:
+                if sys is None:
+                    # The interpreter is exiting, and has removed this
+                    # module's globals.
+                    return
+                receiveError = sys.exc_info()
+                sys.stderr.write('courier.resolver receiver error: %s:%s\n' %
+                                 (receiveError[0], receiveError[1]))
+                time.sleep(0.1)
+
+    def _receiveOnce(self):
+        """Expire outstanding queries and read any replies that arrive."""
+        now = time.time()
+        expired = []
+        self._lock.acquire()
+        try:
+            waitTime = min(1.0, timeout)
+            for (queryId, outstanding) in self._outstanding.items():
+                if outstanding.deadline <= now:
+                    del self._outstanding[queryId]
+                    expired.append(outstanding)
+                else:
+                    waitTime = min(waitTime, outstanding.deadline - now)
+            if self._oldSockets:
+                inUse = set([x.sock for x in self._outstanding.values()])
+                for sock in self._oldSockets[:]:
+                    if sock not in inUse:
+                        self._oldSockets.remove(sock)
+                        sock.close()
+            sockets = self._sockets.values() + self._oldSockets
+            wakeup = self._wakeup[0]
+        finally:
+            self._lock.release()
+        for outstanding in expired:
+            outstanding.finish(None)
+        try:
+            readySockets = select.select(sockets + [wakeup], [], [], waitTime)[0]
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                return
+            raise
+        if wakeup in readySockets:
+            os.read(wakeup, 512)
+            readySockets.remove(wakeup)
+        for sock in readySockets:
+            try:
+                (message, address) = sock.recvfrom(65535)
+            except socket.error:
+                continue
+            self._receive(message, address, sock)
+
+    def _receive(self, message, address, sock):
+        try:
+            reply = _parseReply(message)
+        except ResolverError:
+            return
+        self._lock.acquire()
+        try:
+            outstanding = self._outstanding.get(reply['id'])
+            # Ignore replies that don't match the server and question,
+            # which might be forged.
+            if(outstanding is None
+               or sock is not outstanding.sock
+               or address[0] != outstanding.server
+               or address[1] != port
+               or reply['questions'] != [outstanding.question]):
+                return
+            del self._outstanding[reply['id']]
+        finally:
+            self._lock.release()
+        outstanding.finish(reply)
+
+    def _queryTcp(self, server, name, qtype):
+        if ':' in server:
+            family = socket.AF_INET6
+        else:
+            family = socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            queryId = _random.randint(0, 65535)
+            query = _makeQuery(queryId, name, qtype)
+            sock.connect((server, port))
+            sock.sendall(struct.pack('!H', len(query)) + query)
+            length = struct.unpack('!H', _recvAll(sock, 2))[0]
+            reply = _parseReply(_recvAll(sock, length))
+        finally:
+            sock.close()
+        if reply['id'] != queryId or reply['questions'] != [(name, qtype)]:
+            raise ResolverError('Mismatched reply')
+        return reply
+
+
+def _recvAll(sock, length):
+    data = []
+    while length:
+        chunk = sock.recv(length)
+        if not chunk:
+            raise ResolverError('Connection closed')
+        data.append(chunk)
+        length -= len(chunk)
+    return ''.join(data)
+
+
+def _readResolvConf():
+    servers = []
+    try:
+        resolvFile = open(resolvConf)
+    except IOError:
+        return ['127.0.0.1']
+    try:
+        for line in resolvFile:
+            words = line.split()
+            if len(words) > 1 and words[0] == 'nameserver':
+                servers.append(words[1])
+    finally:
+        resolvFile.close()
+    return servers or ['127.0.0.1']
+
+
+##############################
+# Shared resolver and helpers
+##############################
+_resolver = [None]
+_resolverLock = thread.allocate_lock()
+def getResolver():
+    """Return the Resolver shared by all filters."""
+    _resolverLock.acquire()
+    try:
+        if _resolver[0] is None:
+            _resolver[0] = Resolver()
+        return _resolver[0]
+    finally:
+        _resolverLock.release()
+
+
+def query(name, qtype):
+    """Return the values of name's records of type qtype.
+
+    See Resolver.query.
+
+    """
+    return getResolver().query(name, qtype)
+
+
+def prefetch(queries):
+    """Start lookups for a list of (name, qtype) tuples.
+
+    The queries are sent at the same time, without waiting for their
+    replies, which are cached for later queries.  See Resolver.prefetch.
+
+    """
+    resolver = getResolver()
+    for (name, qtype) in queries:
+        resolver.prefetch(name, qtype)
+
+
+def addresses(name):
+    """Return a list of the IPv4 and IPv6 addresses of name."""
+    return query(name, A) + query(name, AAAA)
+
+
+def mxlookup(name):
+    """Return a list of (preference, exchange) tuples, sorted by preference."""
+    mxList = query(name, MX)
+    mxList.sort()
+    return mxList
+
+
+def txt(name):
+    """Return a list of the TXT records of name, each joined into a string."""
+    return [''.join(x) for x in query(name, TXT)]
+
+
+def ptr(ip):
+    """Return a list of the names found by a reverse lookup of ip."""
+    return query(reverseName(ip), PTR)
+
+
+def spfDNSLookup(name, qtype, *args, **kwargs):
+    """A replacement for pyspf's DNSLookup function.
+
+    Filters that use pyspf can set spf.DNSLookup to this function so
+    that SPF checks use the shared cache.  Records are returned in
+    the format that pyspf expects from its pydns driver.
+
+    """
+    qtypeName = qtype.upper()
+    try:
+        records = getResolver().queryRecords(str(name), _typeNames[qtypeName])
+    except ResolverError, e:
+        if spf:
+            raise spf.TempError('DNS %s' % e)
+        raise
+    results = []
+    for (rname, rtype, ttl, value) in records:
+        for (typeName, typeNumber) in _typeNames.items():
+            if typeNumber == rtype:
+                break
+        else:
+            continue
+        if rtype == AAAA:
+            value = socket.inet_pton(socket.AF_INET6, value)
+        elif rtype in (TXT, SPF):
+            value = list(value)
+        results.append(((rname, typeName), value))
+    return results
+
+
+def _setup():
+    courier.config.applyModuleConfig('resolver.py', globals())
+
+
+_setup()
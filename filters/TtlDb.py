@@ -17,11 +17,36 @@
 # You should have received a copy of the GNU General Public License
 # along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import sys
 import thread
+import threading
 import time
+import traceback
 import courier.config
 
 
+# TtlDbDbm.purge removes expired keys a little at a time, so that it
+# never holds the db lock for more than this number of seconds.
+_purgeSliceTime = 0.05
+# TtlDbSQL.purge deletes no more than this number of rows in each
+# transaction, so that it doesn't hold table locks for long.
+_purgeChunkSize = 1000
+# The purge thread started by startPurging checks each db at this
+# interval, in seconds.
+_purgeCheckInterval = 1
+# The SQL backends share no more than this number of connections among
+# all of their tables, unless poolSize is set in the TtlDb section of
+# pythonfilter-modules.conf.  Connections that have been idle for
+# _poolCheckIdle seconds are checked before they are used.
+_poolSize = 10
+_poolCheckIdle = 30
+# get_many, set_many and delete_many name no more than this number of
+# keys in each SQL statement, or fewer if the backend's max_variables
+# requires it.
+_batchSize = 500
+
+
 class TtlDbError(Exception):
     """Base class for exceptions in this module."""
     pass
@@ -45,31 +70,142 @@ class OpenError(TtlDbError):
     pass
 
 
+class _ConnectionPool(object):
+    """Connections to an SQL server, shared by all of the TtlDbSQL
+    instances of one class.
+
+    Each thread checks a connection out of the pool for the duration
+    of a single statement, so that threads don't wait for each other's
+    queries.  No more than poolSize connections are open at once.  A
+    connection that has been idle for more than _poolCheckIdle seconds
+    is checked with a trivial query before it is used, and replaced if
+    it fails.
+
+    """
+    def __init__(self, dbClass, poolSize):
+        self.dbClass = dbClass
+        self.lock = thread.allocate_lock()
+        self.slots = threading.BoundedSemaphore(poolSize)
+        self.idle = []
+        self.pid = os.getpid()
+
+    def get(self):
+        """Return a connection, which must be given to put or discard."""
+        self.slots.acquire()
+        try:
+            while 1:
+                self.lock.acquire()
+                try:
+                    if self.pid != os.getpid():
+                        # Connections can't be shared with the parent
+                        # process.
+                        self.idle = []
+                        self.pid = os.getpid()
+                    if not self.idle:
+                        break
+                    (connection, lastUsed) = self.idle.pop()
+                finally:
+                    self.lock.release()
+                if(time.time() - lastUsed < _poolCheckIdle
+                   or self._isHealthy(connection)):
+                    return connection
+                self._close(connection)
+            return self.dbClass._newConnection()
+        except:
+            self.slots.release()
+            raise
+
+    def put(self, connection):
+        """Return a working connection to the pool."""
+        self.lock.acquire()
+        try:
+            self.idle.append((connection, time.time()))
+        finally:
+            self.lock.release()
+        self.slots.release()
+
+    def discard(self, connection):
+        """Close a connection that may not work, rather than reuse it."""
+        self._close(connection)
+        self.slots.release()
+
+    def _isHealthy(self, connection):
+        try:
+            c = connection.cursor()
+            try:
+                c.execute('SELECT 1')
+                c.fetchone()
+            finally:
+                c.close()
+            connection.rollback()
+        except:
+            return False
+        return True
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except:
+            pass
+
+
+_pools = {}
+_poolsLock = thread.allocate_lock()
+def _getPool(dbClass):
+    _poolsLock.acquire()
+    try:
+        if dbClass not in _pools:
+            dbConfig = courier.config.getModuleConfig('TtlDb')
+            poolSize = int(dbConfig.get('poolSize', _poolSize))
+            _pools[dbClass] = _ConnectionPool(dbClass, poolSize)
+        return _pools[dbClass]
+    finally:
+        _poolsLock.release()
+
+
 class TtlDbSQL(object):
     """Wrapper for SQL db containing tokens with a TTL."""
 
     dbapi_name = None
     paramstyle = None
     create_statement = 'CREATE TABLE %s (id CHAR(64) NOT NULL, value BIGINT NOT NULL, PRIMARY KEY(id))'
-    purge_statement = 'DELETE FROM %s WHERE value < $1'
+    purge_statement = ('DELETE FROM %(table)s WHERE id IN '
+                       '(SELECT id FROM %(table)s WHERE value < $1 LIMIT $2)')
     select_statement = 'SELECT value FROM %s WHERE id = $1'
     insert_statement = 'INSERT INTO %s VALUES ($1, $2)'
     update_statement = 'UPDATE %s SET value=$2 WHERE id=$1'
+    # If upsert_statement is None, __setitem__ will try to insert a
+    # row, and update it if that fails.
+    upsert_statement = ('INSERT INTO %s VALUES ($1, $2) '
+                        'ON CONFLICT (id) DO UPDATE SET value = EXCLUDED.value')
+    # set_many appends this to a multi-row INSERT statement.
+    upsert_clause = ' ON CONFLICT (id) DO UPDATE SET value = EXCLUDED.value'
     delete_statement = 'DELETE FROM %s WHERE id = $1'
+    # The largest number of parameters that the database allows in one
+    # statement, or None if it has no practical limit.
+    max_variables = None
 
     def __init__(self, name, TTL, PurgeInterval):
         self.dbLock = thread.allocate_lock()
 
         if self.dbapi_name is None:
             raise OpenError('Do not use TtlDbSQL directly.  Subclass and define "dbapi".')
-        self.dbapi = __import__(self.dbapi_name)
+        self.dbapi = self._dbapi()
         # This allows a subclass to override the SQL module's own
         # paramstyle setting, especially for modules like MySQL
         # which support multiple styles.
         if self.paramstyle is None:
             self.paramstyle = self.dbapi.paramstyle
         self.tablename = name
-        self._connect()
+        # The statements are formatted with the table name only once.
+        self._purge = self.purge_statement % {'table': name}
+        self._select = self.select_statement % name
+        self._insert = self.insert_statement % name
+        self._update = self.update_statement % name
+        self._upsert = self.upsert_statement and self.upsert_statement % name
+        self._delete = self.delete_statement % name
+        self.pool = _getPool(self.__class__)
+        self._createTable()
         # The db will be scrubbed at the interval indicated in seconds.
         # All records older than the "TTL" number of seconds will be
         # removed from the db.
@@ -80,27 +216,47 @@ class TtlDbSQL(object):
         # will not be purged until the PurgeInterval has passed.
         self.LastPurged = 0
 
-    def _connect(self):
+    def _dbapi(cls):
+        return __import__(cls.dbapi_name)
+    _dbapi = classmethod(_dbapi)
+
+    def _connectArgs(cls, dbConfig):
+        """Return the keyword arguments for the SQL module's connect()."""
+        return {'user': dbConfig['user'],
+                'password': dbConfig['password'],
+                'host': dbConfig['host'],
+                'port': int(dbConfig['port']),
+                'database': dbConfig['db']}
+    _connectArgs = classmethod(_connectArgs)
+
+    def _newConnection(cls):
+        """Open a new connection with the current settings."""
         dbConfig = courier.config.getModuleConfig('TtlDb')
         try:
-            self.db = self.dbapi.connect(user=dbConfig['user'],
-                                         password=dbConfig['password'],
-                                         host=dbConfig['host'],
-                                         port=int(dbConfig['port']),
-                                         database=dbConfig['db'])
+            return cls._dbapi().connect(**cls._connectArgs(dbConfig))
         except:
-            raise OpenError('Failed to open %s SQL db, check settings in pythonfilter-modules.conf' % (dbConfig['db']))
+            raise OpenError('Failed to open %s SQL db, check settings in pythonfilter-modules.conf' % (dbConfig.get('db')))
+    _newConnection = classmethod(_newConnection)
+
+    def _createTable(self):
+        connection = self.pool.get()
         try:
             try:
-                c = self.db.cursor()
-                c.execute(self.create_statement % self.tablename)
-                self.db.commit()
+                c = connection.cursor()
+                try:
+                    c.execute(self.create_statement % self.tablename)
+                finally:
+                    c.close()
+                connection.commit()
             except:
-                self.db.rollback()
-        finally:
-            c.close()
+                # The table probably exists already.
+                connection.rollback()
+        except:
+            self.pool.discard(connection)
+            raise
+        self.pool.put(connection)
 
-    def _dbExec(self, query, params=None, reconnect=True):
+    def _execParams(self, params):
         exec_params = None
         if params:
             if self.paramstyle == 'numeric':
@@ -108,35 +264,72 @@ class TtlDbSQL(object):
             elif(self.paramstyle == 'pyformat'
                  or self.paramstyle == 'named'):
                 exec_params = dict(params)
+        return exec_params
+
+    def _placeholder(self, params, name, value):
+        """Add a parameter to params, and return its placeholder."""
+        params.append((name, value))
+        if self.paramstyle == 'numeric':
+            return '$%d' % len(params)
+        elif self.paramstyle == 'named':
+            return ':%s' % name
+        else:
+            return '%%(%s)s' % name
+
+    def _dbExec(self, statements, fetch):
+        """Run statements on a pooled connection in a single transaction.
+
+        statements is a list of (query, params) tuples.  If fetch is
+        true, return a list of all of the rows returned.  Otherwise,
+        commit the statements and return the total row count.
+
+        """
+        connection = self.pool.get()
         try:
-            c = self.db.cursor()
-            c.execute(query, exec_params)
+            c = connection.cursor()
+            try:
+                if fetch:
+                    result = []
+                else:
+                    result = 0
+                for (query, params) in statements:
+                    c.execute(query, self._execParams(params))
+                    if fetch:
+                        result.extend(c.fetchall())
+                    else:
+                        result += c.rowcount
+            finally:
+                c.close()
+            if fetch:
+                connection.rollback()
+            else:
+                connection.commit()
         except self.dbapi.OperationalError:
-            c.close()
-            if reconnect:
-                self._connect()
-                c = self._dbExec(query, params, reconnect=False)
+            # The connection may be broken.
+            self.pool.discard(connection)
+            raise
+        except:
+            dbError = sys.exc_info()
+            try:
+                connection.rollback()
+            except:
+                self.pool.discard(connection)
             else:
-                raise
-        return c
+                self.pool.put(connection)
+            raise dbError[0], dbError[1], dbError[2]
+        self.pool.put(connection)
+        return result
 
     def _dbRead(self, query, params=None):
-        c = self._dbExec(query, params)
-        r = c.fetchone()
-        c.close()
+        r = self._dbExec([(query, params)], True)
         if r:
-            return str(r[0])
+            return str(r[0][0])
         else:
             return None
 
     def _dbWrite(self, query, params=None):
-        try:
-            c = self._dbExec(query, params)
-        except:
-            self.db.rollback()
-            raise
-        self.db.commit()
-        c.close()
+        """Execute a statement, commit it, and return its row count."""
+        return self._dbExec([(query, params)], False)
 
     def lock(self):
         self.dbLock.acquire()
@@ -149,41 +342,123 @@ class TtlDbSQL(object):
         """Remove all keys who have outlived their TTL.
 
         Don't call this function inside a locked section of code.
+        Rows are deleted in chunks of _purgeChunkSize, each in its own
+        transaction, and the lock is released between chunks.  Return
+        True.
         """
-        self.lock()
-        try:
-            if time.time() > (self.LastPurged + self.PurgeInterval):
-                # Any token whose value is less than "minVal" is no longer valid.
-                minVal = int(time.time() - self.TTL)
-                self._dbWrite(self.purge_statement % self.tablename,
-                              (('value', minVal),))
-                self.LastPurged = time.time()
-        finally:
-            self.unlock()
+        if time.time() <= (self.LastPurged + self.PurgeInterval):
+            return True
+        # Any token whose value is less than "minVal" is no longer valid.
+        minVal = int(time.time() - self.TTL)
+        while 1:
+            self.lock()
+            try:
+                count = self._dbWrite(self._purge, (('value', minVal),
+                                                    ('limit', _purgeChunkSize)))
+            finally:
+                self.unlock()
+            if count < _purgeChunkSize:
+                break
+        self.LastPurged = time.time()
+        return True
 
     def __contains__(self, key):
-        value = self._dbRead(self.select_statement % self.tablename,
-                             (('id', key),))
+        value = self._dbRead(self._select, (('id', key),))
         return bool(value)
     # Maintain compatibility with the old method:
     has_key = __contains__
 
     def __getitem__(self, key):
-        value = self._dbRead(self.select_statement % self.tablename,
-                             (('id', key),))
+        value = self._dbRead(self._select, (('id', key),))
         return value
 
     def __setitem__(self, key, value):
+        if self._upsert:
+            self._dbWrite(self._upsert, (('id', key), ('value', int(value))))
+            return
         try:
-            self._dbWrite(self.insert_statement % self.tablename,
-                          (('id', key), ('value', int(value))))
+            self._dbWrite(self._insert, (('id', key), ('value', int(value))))
         except (self.dbapi.ProgrammingError, self.dbapi.IntegrityError):
-            self._dbWrite(self.update_statement % self.tablename,
-                          (('id', key), ('value', int(value))))
+            self._dbWrite(self._update, (('id', key), ('value', int(value))))
 
     def __delitem__(self, key):
-        self._dbWrite(self.delete_statement % self.tablename,
-                      (('id', key),))
+        self._dbWrite(self._delete, (('id', key),))
+
+    def get_many(self, keys):
+        """Return a dictionary of the values of those keys that exist.
+
+        The keys are looked up with no more than _batchSize keys in
+        each statement, or fewer if the database limits the number of
+        parameters in a statement.
+        """
+        # CHAR columns may be returned padded with spaces.
+        keysById = dict([(key.rstrip(' '), key) for key in keys])
+        statements = self._inStatements('SELECT id, value FROM %s WHERE id IN (%%s)',
+                                         keysById.keys())
+        values = {}
+        if statements:
+            for (rowId, value) in self._dbExec(statements, True):
+                values[keysById[rowId.rstrip(' ')]] = str(value)
+        return values
+
+    def set_many(self, mapping):
+        """Set the values of the keys in mapping.
+
+        If upserts are supported, all of the keys are set in one
+        transaction, by multi-row statements.
+        """
+        items = mapping.items()
+        if not self._upsert:
+            for (key, value) in items:
+                self[key] = value
+            return
+        # Each row has two parameters.
+        batchSize = self._keysPerStatement(2)
+        statements = []
+        for start in range(0, len(items), batchSize):
+            params = []
+            rows = []
+            for (key, value) in items[start:start + batchSize]:
+                x = len(rows)
+                rows.append('(%s, %s)' %
+                            (self._placeholder(params, 'id%d' % x, key),
+                             self._placeholder(params, 'value%d' % x, int(value))))
+            statements.append(('INSERT INTO %s VALUES %s%s' %
+                               (self.tablename, ', '.join(rows), self.upsert_clause),
+                               params))
+        if statements:
+            self._dbExec(statements, False)
+
+    def delete_many(self, keys):
+        """Remove keys, in one transaction.  Missing keys are ignored."""
+        statements = self._inStatements('DELETE FROM %s WHERE id IN (%%s)',
+                                        list(keys))
+        if statements:
+            self._dbExec(statements, False)
+
+    def _inStatements(self, query, keys):
+        """Return a list of (query, params) tuples for keys.
+
+        query is formatted with the table name, and then with the
+        placeholders for no more than _batchSize keys, or fewer if
+        the database limits the number of parameters in a statement.
+        """
+        query = query % self.tablename
+        batchSize = self._keysPerStatement(1)
+        statements = []
+        for start in range(0, len(keys), batchSize):
+            params = []
+            placeholders = []
+            for key in keys[start:start + batchSize]:
+                placeholders.append(self._placeholder(params, 'id%d' % len(params), key))
+            statements.append((query % ', '.join(placeholders), params))
+        return statements
+
+    def _keysPerStatement(self, paramsPerKey):
+        """Return the number of keys to name in each statement."""
+        if self.max_variables is None:
+            return _batchSize
+        return min(_batchSize, self.max_variables // paramsPerKey)
 
 
 class TtlDbPg(TtlDbSQL):
@@ -196,10 +471,13 @@ class TtlDbPsycopg2(TtlDbSQL):
     """Wrapper for SQL db containing tokens with a TTL."""
 
     dbapi_name = 'psycopg2'
-    purge_statement = 'DELETE FROM %s WHERE value < %%(value)s'
+    purge_statement = ('DELETE FROM %(table)s WHERE id IN '
+                       '(SELECT id FROM %(table)s WHERE value < %%(value)s LIMIT %%(limit)s)')
     select_statement = 'SELECT value FROM %s WHERE id = %%(id)s'
     insert_statement = 'INSERT INTO %s VALUES (%%(id)s, %%(value)s)'
     update_statement = 'UPDATE %s SET value=%%(value)s WHERE id=%%(id)s'
+    upsert_statement = ('INSERT INTO %s VALUES (%%(id)s, %%(value)s) '
+                        'ON CONFLICT (id) DO UPDATE SET value = EXCLUDED.value')
     delete_statement = 'DELETE FROM %s WHERE id = %%(id)s'
 
 
@@ -208,32 +486,66 @@ class TtlDbMySQL(TtlDbPsycopg2):
 
     dbapi_name = 'MySQLdb'
     paramstyle = 'pyformat'
+    # MySQL doesn't support LIMIT in an IN subquery, but does support
+    # it in DELETE.
+    purge_statement = 'DELETE FROM %(table)s WHERE value < %%(value)s LIMIT %%(limit)s'
+    upsert_statement = ('INSERT INTO %s VALUES (%%(id)s, %%(value)s) '
+                        'ON DUPLICATE KEY UPDATE value = VALUES(value)')
+    upsert_clause = ' ON DUPLICATE KEY UPDATE value = VALUES(value)'
+
+    def _connectArgs(cls, dbConfig):
+        # MySQLdb requires a set of parameters different than PEP 249.
+        return {'user': dbConfig['user'],
+                'passwd': dbConfig['password'],
+                'host': dbConfig['host'],
+                'port': int(dbConfig['port']),
+                'db': dbConfig['db']}
+    _connectArgs = classmethod(_connectArgs)
+
+
+class TtlDbSQLite(TtlDbSQL):
+    """Wrapper for SQLite db containing tokens with a TTL.
+
+    All of the tables are stored in one file, named by the "db"
+    setting.  If that isn't an absolute path, the file is created in
+    the directory named by the "dir" setting.
 
-    def _connect(self):
-        dbConfig = courier.config.getModuleConfig('TtlDb')
-        try:
-            # MySQLdb requires a set of parameters different than PEP 249.
-            self.db = self.dbapi.connect(user=dbConfig['user'],
-                                         passwd=dbConfig['password'],
-                                         host=dbConfig['host'],
-                                         port=int(dbConfig['port']),
-                                         db=dbConfig['db'])
-        except:
-            raise OpenError('Failed to open %s SQL db, check settings in pythonfilter-modules.conf' % (dbConfig['db']))
-        try:
-            try:
-                c = self.db.cursor()
-                c.execute(self.create_statement % self.tablename)
-                self.db.commit()
-            except:
-                self.db.rollback()
-        finally:
-            c.close()
+    """
+
+    dbapi_name = 'sqlite3'
+    paramstyle = 'named'
+    purge_statement = ('DELETE FROM %(table)s WHERE id IN '
+                       '(SELECT id FROM %(table)s WHERE value < :value LIMIT :limit)')
+    select_statement = 'SELECT value FROM %s WHERE id = :id'
+    insert_statement = 'INSERT INTO %s VALUES (:id, :value)'
+    update_statement = 'UPDATE %s SET value=:value WHERE id=:id'
+    upsert_statement = ('INSERT INTO %s VALUES (:id, :value) '
+                        'ON CONFLICT (id) DO UPDATE SET value = excluded.value')
+    delete_statement = 'DELETE FROM %s WHERE id = :id'
+    # SQLITE_MAX_VARIABLE_NUMBER before SQLite 3.32.
+    max_variables = 999
+
+    def __init__(self, name, TTL, PurgeInterval):
+        TtlDbSQL.__init__(self, name, TTL, PurgeInterval)
+        if self.dbapi.sqlite_version_info < (3, 24, 0):
+            # ON CONFLICT is not supported.
+            self._upsert = None
+
+    def _connectArgs(cls, dbConfig):
+        path = os.path.join(dbConfig.get('dir', ''),
+                            dbConfig.get('db', 'TtlDb.sqlite'))
+        # Connections are shared by all threads through the pool, but
+        # used by only one thread at a time.
+        return {'database': path,
+                'check_same_thread': False}
+    _connectArgs = classmethod(_connectArgs)
 
 
 class TtlDbDbm(object):
     """Wrapper for dbm containing tokens with a TTL."""
     def __init__(self, name, TTL, PurgeInterval):
+        if _workerProcesses:
+            raise OpenError('Failed to open %s db, dbm files can not be shared by pythonfilter worker processes\n' % name)
         self.dbLock = thread.allocate_lock()
 
         import anydbm
@@ -250,8 +562,19 @@ class TtlDbDbm(object):
         self.PurgeInterval = PurgeInterval
         # A value of 0 will cause the db to purge the first time the
         # purge() function is called.  After the first time, the db
-        # will not be purged until the PurgeInterval has passed.
+        # will not be purged until the PurgeInterval has passed, unless
+        # the last purge ran out of time before it was finished.
         self.LastPurged = 0
+        # Keys are indexed by the time that they were last set, in
+        # buckets of PurgeInterval seconds, so that expired keys can be
+        # found without reading the whole db.  A key that is set again
+        # is added to a new bucket and left in the old one, so each key
+        # is checked before it is removed.  Keys that were in the db
+        # when it was opened are indexed by purge, a few at a time, as
+        # they are read by _scanKeys.
+        self._bucketSize = max(int(PurgeInterval), 1)
+        self._buckets = {}
+        self._unindexed = self._scanKeys()
 
     def lock(self):
         self.dbLock.acquire()
@@ -272,19 +595,113 @@ class TtlDbDbm(object):
         """Remove all keys who have outlived their TTL.
 
         Don't call this function inside a locked section of code.
+        Return True if all expired keys were removed, or False if more
+        remain to be removed by the next call.
         """
+        if time.time() <= (self.LastPurged + self.PurgeInterval):
+            return True
         self.lock()
         try:
             if time.time() > (self.LastPurged + self.PurgeInterval):
-                # Any token whose value is less than "minVal" is no longer valid.
-                minVal = time.time() - self.TTL
-                for key in self.db.keys():
-                    if float(self.db[key]) < minVal:
-                        del self.db[key]
+                if not self._purgeSlice(time.time() + _purgeSliceTime):
+                    return False
                 self.LastPurged = time.time()
+            return True
         finally:
             self.unlock()
 
+    def _purgeSlice(self, deadline):
+        """Index and remove expired keys until deadline.
+
+        Return True if all expired keys were removed, or False if time
+        ran out first.  The caller must hold the lock.
+
+        """
+        count = 0
+        while self._unindexed is not None:
+            count += 1
+            if count % 100 == 0 and time.time() > deadline:
+                return False
+            try:
+                key = self._unindexed.next()
+            except StopIteration:
+                self._unindexed = None
+                break
+            try:
+                self._index(key, self.db[key])
+            except KeyError:
+                pass
+        # Any token whose value is less than "minVal" is no longer valid.
+        minVal = time.time() - self.TTL
+        for bucket in sorted(self._buckets):
+            if (bucket + 1) * self._bucketSize > minVal:
+                # This bucket, and all those after it, may hold keys
+                # that are still valid.
+                break
+            keys = self._buckets[bucket]
+            while keys:
+                count += 1
+                if count % 100 == 0 and time.time() > deadline:
+                    return False
+                key = keys.pop()
+                try:
+                    if float(self.db[key]) < minVal:
+                        del self.db[key]
+                except KeyError:
+                    pass
+            del self._buckets[bucket]
+        return True
+
+    def _scanKeys(self):
+        """Yield the keys in the db.
+
+        gdbm and dbhash files are read with a cursor, one key at a
+        time, so the scan can be spread over many purge slices without
+        reading a list of all of the keys.  Other dbm modules only
+        provide that list, which is read when the scan starts.  gdbm
+        keys that are missed because the db changed during the scan
+        will be indexed when they are next set.
+
+        """
+        if hasattr(self.db, 'firstkey'):
+            # gdbm
+            key = self.db.firstkey()
+            while key is not None:
+                yield key
+                key = self.db.nextkey(key)
+        elif hasattr(self.db, 'first'):
+            # dbhash.  bsddb raises DBNotFoundError, a KeyError, at the
+            # end of the file, but also when the key under the cursor
+            # has been deleted by another thread, because the cursor
+            # is reopened at that key.  In that case, the scan starts
+            # again; keys that were indexed already are harmlessly
+            # indexed again.
+            try:
+                key = self.db.first()[0]
+            except KeyError:
+                return
+            while 1:
+                yield key
+                try:
+                    key = self.db.next()[0]
+                except KeyError:
+                    if key in self.db:
+                        return
+                    try:
+                        key = self.db.first()[0]
+                    except KeyError:
+                        return
+        else:
+            for key in self.db.keys():
+                yield key
+
+    def _index(self, key, value):
+        bucket = int(float(value)) // self._bucketSize
+        keys = self._buckets.get(bucket)
+        if keys is None:
+            keys = self._buckets[bucket] = set()
+        keys.add(key)
+
     def __contains__(self, key):
         return self.db.__contains__(key)
     # Maintain compatibility with the old method:
@@ -295,17 +712,119 @@ class TtlDbDbm(object):
 
     def __setitem__(self, key, value):
         self.db[key] = str(int(value))
+        self._index(key, value)
 
     def __delitem__(self, key):
         del(self.db[key])
 
+    def get_many(self, keys):
+        """Return a dictionary of the values of those keys that exist."""
+        values = {}
+        for key in keys:
+            try:
+                values[key] = self.db[key]
+            except KeyError:
+                pass
+        return values
+
+    def set_many(self, mapping):
+        """Set the values of the keys in mapping."""
+        for (key, value) in mapping.items():
+            self[key] = value
+
+    def delete_many(self, keys):
+        """Remove keys.  Missing keys are ignored."""
+        for key in keys:
+            try:
+                del self.db[key]
+            except KeyError:
+                pass
+
 
 _dbmClasses = {'dbm': TtlDbDbm,
+               'sqlite': TtlDbSQLite,
                'psycopg2': TtlDbPsycopg2,
                'pg': TtlDbPg,
                'mysql': TtlDbMySQL}
 
 
+# Every db opened through TtlDb(), to be purged by the purge thread.
+_dbs = []
+_dbsLock = thread.allocate_lock()
+_purging = False
+_purgePid = None
+# Set by forbidSharing when pythonfilter forks worker processes.
+_workerProcesses = False
+
+
+def forbidSharing():
+    """Refuse to open dbs that can't be shared by several processes.
+
+    dbm files are locked only by the threads of one process, so
+    several processes that write to the same file will corrupt it.
+    pythonfilter calls this function before it forks worker processes.
+    OpenError is raised if a dbm db has already been opened, and dbm
+    dbs opened later will raise OpenError.
+
+    """
+    global _workerProcesses
+    _dbsLock.acquire()
+    try:
+        for db in _dbs:
+            if isinstance(db, TtlDbDbm):
+                raise OpenError('dbm files can not be shared by pythonfilter worker processes\n')
+        _workerProcesses = True
+    finally:
+        _dbsLock.release()
+
+
+def startPurging():
+    """Purge every db opened through TtlDb() in a background thread.
+
+    Each db is purged at its PurgeInterval, so filters don't need to
+    call the purge method while they process a message.  pythonfilter
+    calls this function in each process that filters messages, before
+    deferred filters are loaded.  The thread is started when the first
+    db is opened, and dbs that are opened later are purged as well.
+
+    """
+    global _purging, _purgePid
+    _dbsLock.acquire()
+    try:
+        _purging = True
+        if _purgePid == os.getpid() or not _dbs:
+            return
+        # Threads don't survive fork, so each process needs its own.
+        _purgePid = os.getpid()
+    finally:
+        _dbsLock.release()
+    thread.start_new_thread(_purgeLoop, ())
+
+
+def _purgeLoop():
+    while _purgePid == os.getpid():
+        _dbsLock.acquire()
+        try:
+            dbs = _dbs[:]
+        finally:
+            _dbsLock.release()
+        finished = True
+        for db in dbs:
+            try:
+                if not db.purge():
+                    finished = False
+            except:
+                purgeError = sys.exc_info()
+                sys.stderr.write('TtlDb purge failed: %s:%s\n' %
+                                 (purgeError[0], purgeError[1]))
+                sys.stderr.write(''.join(traceback.format_tb(purgeError[2])))
+        if finished:
+            time.sleep(_purgeCheckInterval)
+        else:
+            # Let other threads use the dbs before the next slice.
+            time.sleep(_purgeSliceTime)
+
+
 def TtlDb(name, TTL, PurgeInterval):
     """Wrapper for db containing tokens with a TTL.
 
@@ -315,8 +834,19 @@ def TtlDb(name, TTL, PurgeInterval):
     be removed from the db if their value indicates that they haven't been
     used within the TTL period.
 
-    A TtlDb.OpenError exception will be raised if the db can't be opened.
+    The db is registered to be purged by the thread started by
+    startPurging.  A TtlDb.OpenError exception will be raised if the
+    db can't be opened.
     """
     dbConfig = courier.config.getModuleConfig('TtlDb')
     dbtype = dbConfig['type']
-    return _dbmClasses[dbtype](name, TTL, PurgeInterval)
+    db = _dbmClasses[dbtype](name, TTL, PurgeInterval)
+    _dbsLock.acquire()
+    try:
+        _dbs.append(db)
+        purging = _purging
+    finally:
+        _dbsLock.release()
+    if purging:
+        startPurging()
+    return db
@@ -24,7 +24,7 @@ import email.charset
 import email.generator
 import email.mime.multipart
 import email.mime.text
-import courier.control
+import courier.context
 import courier.xfilter
 
 
@@ -45,8 +45,10 @@ def initFilter():
     sys.stderr.write('Initialized the "add_signature" python filter\n')
 
 
-def doFilter(bodyFile, controlFileList):
-    sender = courier.control.getAuthUser(controlFileList, bodyFile)
+def doFilter(bodyFile, controlFileList, context=None):
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
+    sender = context.getAuthUser()
     if not sender:
         return ''
     senderBits = sender.split('@')
@@ -21,7 +21,7 @@ import hashlib
 import sys
 import time
 import courier.config
-import courier.control
+import courier.context
 import TtlDb
 
 
@@ -45,44 +45,48 @@ def initFilter():
     sys.stderr.write('Initialized the "auto_whitelist" python filter\n')
 
 
-def _whitelistRecipients(controlFileList):
-    sender = courier.control.getSender(controlFileList).lower()
+def _whitelistRecipients(context):
+    sender = context.getSender().lower()
     senderMd5 = hashlib.md5(sender)
+    cdigests = []
+    for recipient in context.getRecipients():
+        recipient = recipient.lower()
+        # Don't allow a whitelist between identical addresses.  Users
+        # sometimes email themselves a note, which creates a path for
+        # spam.
+        if recipient == sender:
+            continue
+        correspondents = senderMd5.copy()
+        correspondents.update(recipient)
+        cdigests.append(correspondents.hexdigest())
     _whitelist.lock()
     try:
-        for recipient in courier.control.getRecipients(controlFileList):
-            recipient = recipient.lower()
-            # Don't allow a whitelist between identical addresses.  Users
-            # sometimes email themselves a note, which creates a path for
-            # spam.
-            if recipient == sender:
-                continue
-            correspondents = senderMd5.copy()
-            correspondents.update(recipient)
-            cdigest = correspondents.hexdigest()
-            _whitelist[cdigest] = time.time()
+        _whitelist.set_many(dict.fromkeys(cdigests, time.time()))
     finally:
         _whitelist.unlock()
 
 
-def _checkWhitelist(controlFileList):
+def _checkWhitelist(context):
     foundAll = 1
-    sender = courier.control.getSender(controlFileList).lower()
+    sender = context.getSender().lower()
+    cdigests = []
+    for recipient in context.getRecipients():
+        correspondents = hashlib.md5(recipient.lower())
+        correspondents.update(sender)
+        cdigests.append(correspondents.hexdigest())
     _whitelist.lock()
     try:
-        for recipient in courier.control.getRecipients(controlFileList):
-            correspondents = hashlib.md5(recipient.lower())
-            correspondents.update(sender)
-            cdigest = correspondents.hexdigest()
-            if not cdigest in _whitelist:
-                foundAll = 0
-                break
+        found = _whitelist.get_many(cdigests)
     finally:
         _whitelist.unlock()
+    for cdigest in cdigests:
+        if not cdigest in found:
+            foundAll = 0
+            break
     return foundAll
 
 
-def doFilter(bodyFile, controlFileList):
+def doFilter(bodyFile, controlFileList, context=None):
     """Return a 200 code if the message looks like a reply to a message
     sent by an authenticated user.
 
@@ -92,13 +96,14 @@ def doFilter(bodyFile, controlFileList):
 
     """
 
-    _whitelist.purge()
-    authUser = courier.control.getAuthUser(controlFileList, bodyFile)
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
+    authUser = context.getAuthUser()
     if authUser:
-        _whitelistRecipients(controlFileList)
+        _whitelistRecipients(context)
         return ''
     else:
-        if _checkWhitelist(controlFileList):
+        if _checkWhitelist(context):
             return '200 Ok'
         else:
             # Return no decision for everyone else.
@@ -22,6 +22,8 @@ import sys
 import courier.config
 import courier.quarantine
 
+readOnly = True
+
 localSocket = ''
 action = 'reject'
 
@@ -62,6 +64,9 @@ def handleVirus(bodyFile, controlFileList, virusSignature):
 
 def initFilter():
     courier.config.applyModuleConfig('clamav.py', globals())
+    # Quarantining a message modifies its control files.
+    global readOnly
+    readOnly = (action == 'reject')
     courier.quarantine.init()
     # Record in the system log that this filter was initialized.
     sys.stderr.write('Initialized the "clamav" python filter\n')
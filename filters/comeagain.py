@@ -21,7 +21,7 @@ import hashlib
 import sys
 import time
 import courier.config
-import courier.control
+import courier.context
 import TtlDb
 
 
@@ -45,7 +45,7 @@ def initFilter():
     sys.stderr.write('Initialized the "comeagain" python filter\n')
 
 
-def doFilter(bodyFile, controlFileList):
+def doFilter(bodyFile, controlFileList, context=None):
     """Return a temporary failure message if this sender hasn't tried to
     deliver mail previously.
 
@@ -58,17 +58,17 @@ def doFilter(bodyFile, controlFileList):
 
     """
 
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
     # Grab the sender from the control files.
     try:
-        sender = courier.control.getSender(controlFileList)
+        sender = context.getSender()
     except:
         return '451 Internal failure locating control files'
     if sender == '':
         # Null sender is allowed as a non-fatal error
         return ''
 
-    _senders.purge()
-
     # Create a new MD5 object.  The pairs of sender/recipient will
     # be stored in the db in the form of an MD5 digest.
     senderMd5 = hashlib.md5(sender)
@@ -78,15 +78,18 @@ def doFilter(bodyFile, controlFileList):
     # pair does not exist, we'll have to ask the sender to deliver
     # again.
     foundAll=1
+    cdigests = []
+    for recipient in context.getRecipients():
+        correspondents = senderMd5.copy()
+        correspondents.update(recipient)
+        cdigests.append(correspondents.hexdigest())
     _senders.lock()
     try:
-        for recipient in courier.control.getRecipients(controlFileList):
-            correspondents = senderMd5.copy()
-            correspondents.update(recipient)
-            cdigest = correspondents.hexdigest()
-            if not cdigest in _senders:
+        found = _senders.get_many(cdigests)
+        for cdigest in cdigests:
+            if not cdigest in found:
                 foundAll = 0
-            _senders[cdigest] = time.time()
+        _senders.set_many(dict.fromkeys(cdigests, time.time()))
     finally:
         _senders.unlock()
 
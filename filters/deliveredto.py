@@ -17,9 +17,12 @@
 # You should have received a copy of the GNU General Public License
 # along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
 
-import email
 import sys
 import courier.config
+import courier.context
+
+
+readOnly = True
 
 
 def initFilter():
@@ -27,21 +30,19 @@ def initFilter():
     sys.stderr.write('Initialized the "deliveredto" python filter\n')
 
 
-def doFilter(bodyFile, controlFileList):
+def doFilter(bodyFile, controlFileList, context=None):
     """Check 'Delivered-to' header
 
     Reject messages if the Delivered-to header indicates a
     locally hosted domain.
 
     """
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
     try:
-        bfStream = open(bodyFile)
-    except:
+        message = context.getHeaders()
+    except IOError:
         return '451 Internal failure opening message data file'
-    try:
-        message = email.message_from_file(bfStream)
-    except:
-        return '451 Internal failure parsing message data file'
     if 'Delivered-To' in message:
         dheader = message['Delivered-To']
         dparts = dheader.split('@')
@@ -25,8 +25,9 @@ import socket
 import sys
 import time
 import courier.config
+import courier.context
+import courier.resolver
 import TtlDb
-import DNS
 
 
 # The good/bad senders lists will be scrubbed at the interval indicated
@@ -58,13 +59,19 @@ def initFilter():
     except TtlDb.OpenError, e:
         sys.stderr.write('Could not open dialback TtlDb: %s\n' % e)
         sys.exit(1)
-    # Initialize the DNS module
-    DNS.DiscoverNameServers()
     # Record in the system log that this filter was initialized.
     sys.stderr.write('Initialized the dialback python filter\n')
 
 
-def doFilter(bodyFile, controlFileList):
+def prefetch(context):
+    """Return the DNS lookups that doFilter may make for this message."""
+    sender = context.getSender()
+    if sender.count('@') != 1:
+        return []
+    return [(sender.split('@')[1], courier.resolver.MX)]
+
+
+def doFilter(bodyFile, controlFileList, context=None):
     """Contact the MX for this message's sender and validate their address.
 
     Validation will be done by starting an SMTP session with the MX and
@@ -72,9 +79,11 @@ def doFilter(bodyFile, controlFileList):
 
     """
 
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
     # Grab the sender from the control files.
     try:
-        sender = courier.control.getSender(controlFileList)
+        sender = context.getSender()
     except:
         return '451 Internal failure locating control files'
     if sender == '':
@@ -82,8 +91,6 @@ def doFilter(bodyFile, controlFileList):
         return ''
     senderMd5 = hashlib.md5(sender).hexdigest()
 
-    _goodSenders.purge()
-    _badSenders.purge()
     # If this sender is known already, then we don't actually need to do the
     # dialback.  Update the timestamp in the dictionary and then return the
     # status.
@@ -116,9 +123,9 @@ def doFilter(bodyFile, controlFileList):
     # host.  If no A record is found, then perhaps the message is a DSN...
     # Just return a success code if no MX and no A records are found.
     try:
-        mxList = DNS.mxlookup(senderDomain)
+        mxList = courier.resolver.mxlookup(senderDomain)
         if not mxList:
-            if socket.getaddrinfo(senderDomain, 'smtp'):
+            if courier.resolver.addresses(senderDomain):
                 # put this host in the mxList and continue
                 mxList.append((1, senderDomain))
             else:
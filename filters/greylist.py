@@ -24,7 +24,7 @@ import ipaddress
 import sys
 import time
 import courier.config
-import courier.control
+import courier.context
 import TtlDb
 
 
@@ -65,7 +65,7 @@ def initFilter():
     sys.stderr.write('Initialized the "greylist" python filter\n')
 
 
-def doFilter(bodyFile, controlFileList):
+def doFilter(bodyFile, controlFileList, context=None):
     """Return a temporary failure message if this sender hasn't tried to
     deliver mail previously.
 
@@ -81,7 +81,9 @@ def doFilter(bodyFile, controlFileList):
 
     """
 
-    sendersIP = ipaddress.ip_address(unicode(courier.control.getSendersIP(controlFileList))).exploded
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
+    sendersIP = ipaddress.ip_address(unicode(context.getSendersIP())).exploded
     if '.' in sendersIP:
         # For IPv4, use the first three octets
         sendersIPNetwork = sendersIP[:sendersIP.rindex('.')]
@@ -91,7 +93,7 @@ def doFilter(bodyFile, controlFileList):
 
     # Grab the sender from the control files.
     try:
-        sender = courier.control.getSender(controlFileList)
+        sender = context.getSender()
     except:
         return '451 Internal failure locating control files'
     if sender == '':
@@ -99,9 +101,6 @@ def doFilter(bodyFile, controlFileList):
         return ''
     sender = sender.lower()
 
-    _sendersPassed.purge()
-    _sendersNotPassed.purge()
-
     # Create a new MD5 object.  The sender/recipient/IP triplets will
     # be stored in the db in the form of an MD5 digest.
     senderMd5 = hashlib.md5(sender)
@@ -119,20 +118,38 @@ def doFilter(bodyFile, controlFileList):
     foundAll = 1
     biggestTimeToGo = 0
 
-    for recipient in courier.control.getRecipients(controlFileList):
+    # The list keeps the recipients' order, and the set finds the
+    # digests that are already in it.
+    cdigests = []
+    seenDigests = set()
+    for recipient in context.getRecipients():
         recipient = recipient.lower()
 
         correspondents = senderMd5.copy()
         correspondents.update(recipient)
         correspondents.update(sendersIPNetwork)
         cdigest = correspondents.hexdigest()
-        _sendersPassed.lock()
-        _sendersNotPassed.lock()
-        try:
-            if cdigest in _sendersNotPassed:
+        if cdigest not in seenDigests:
+            seenDigests.add(cdigest)
+            cdigests.append(cdigest)
+
+    # All of the triplets are looked up and updated together, so that
+    # SQL dbs need only a few statements for any number of recipients.
+    _sendersPassed.lock()
+    _sendersNotPassed.lock()
+    try:
+        notPassed = _sendersNotPassed.get_many(cdigests)
+        passed = _sendersPassed.get_many([x for x in cdigests
+                                          if x not in notPassed])
+        now = time.time()
+        updatePassed = {}
+        updateNotPassed = {}
+        deleteNotPassed = []
+        for cdigest in cdigests:
+            if cdigest in notPassed:
                 _Debug('found triplet in the NotPassed db')
-                firstTimestamp = float(_sendersNotPassed[cdigest])
-                timeToGo = firstTimestamp + greylistTime - time.time()
+                firstTimestamp = float(notPassed[cdigest])
+                timeToGo = firstTimestamp + greylistTime - now
                 if timeToGo > 0:
                     # The sender needs to wait longer before this delivery is allowed.
                     _Debug('triplet in NotPassed db is not old enough')
@@ -141,21 +158,27 @@ def doFilter(bodyFile, controlFileList):
                         biggestTimeToGo = timeToGo
                 else:
                     _Debug('triplet in NotPassed db is now passed')
-                    _sendersPassed[cdigest] = time.time()
-                    del(_sendersNotPassed[cdigest])
-            elif cdigest in _sendersPassed:
+                    updatePassed[cdigest] = now
+                    deleteNotPassed.append(cdigest)
+            elif cdigest in passed:
                 _Debug('triplet found in the Passed db')
-                _sendersPassed[cdigest] = time.time()
+                updatePassed[cdigest] = now
             else:
                 _Debug('new triplet in this message')
                 foundAll = 0
                 timeToGo = greylistTime
                 if timeToGo > biggestTimeToGo:
                     biggestTimeToGo = timeToGo
-                _sendersNotPassed[cdigest] = time.time()
-        finally:
-            _sendersNotPassed.unlock()
-            _sendersPassed.unlock()
+                updateNotPassed[cdigest] = now
+        if updatePassed:
+            _sendersPassed.set_many(updatePassed)
+        if deleteNotPassed:
+            _sendersNotPassed.delete_many(deleteNotPassed)
+        if updateNotPassed:
+            _sendersNotPassed.set_many(updateNotPassed)
+    finally:
+        _sendersNotPassed.unlock()
+        _sendersPassed.unlock()
 
     if foundAll:
         return ''
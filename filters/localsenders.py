@@ -20,9 +20,11 @@
 import sys
 import courier.authdaemon
 import courier.config
-import courier.control
+import courier.context
 
 
+readOnly = True
+
 requireAuth = False
 
 
@@ -32,10 +34,12 @@ def initFilter():
     sys.stderr.write('Initialized the "localsenders" python filter\n')
 
 
-def doFilter(bodyFile, controlFileList):
+def doFilter(bodyFile, controlFileList, context=None):
     """Validate sender addresses, if their domain is locally hosted."""
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
     try:
-        sender = courier.control.getSender(controlFileList)
+        sender = context.getSender()
     except:
         return '451 Internal failure locating control files'
     sparts = sender.split('@')
@@ -53,7 +57,7 @@ def doFilter(bodyFile, controlFileList):
     if senderInfo is None:
         return '517 Sender does not exist: %s' % sender
     if(requireAuth and
-       courier.control.getAuthUser(controlFileList, bodyFile) is None):
+       context.getAuthUser() is None):
         return '517 Policy requires local senders to authenticate.'
     return ''
 
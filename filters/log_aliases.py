@@ -18,7 +18,7 @@
 # along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
-import courier.control
+import courier.context
 
 
 def initFilter():
@@ -26,8 +26,10 @@ def initFilter():
     sys.stderr.write('Initialized the "log_aliases" python filter\n')
 
 
-def doFilter(bodyFile, controlFileList):
-    for addr in courier.control.getRecipientsData(controlFileList):
+def doFilter(bodyFile, controlFileList, context=None):
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
+    for addr in context.getRecipientsData():
         if addr[1]:
             if(addr[1].startswith('rfc822;')):
                 addr[1] = addr[1][7:]
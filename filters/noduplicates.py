@@ -35,11 +35,13 @@ def doFilter(bodyFile, controlFileList):
     """
     rcpts = courier.control.getRecipientsData(controlFileList)
     rdups = {}
+    duplicates = []
     for x in rcpts:
         if x[0] in rdups:
             sys.stderr.write('noduplicates filter: Removing duplicate address "%s" from control file.\n' % x[0])
-            courier.control.delRecipientData(controlFileList, x)
+            duplicates.append(x)
         rdups[x[0]] = 1
+    courier.control.delRecipientsData(controlFileList, duplicates)
     # Return no decision.
     return ''
 
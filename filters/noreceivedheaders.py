@@ -18,7 +18,7 @@
 # along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
-import courier.control
+import courier.context
 import courier.xfilter
 
 
@@ -27,9 +27,11 @@ def initFilter():
     sys.stderr.write('Initialized the "noreceivedheaders" python filter\n')
 
 
-def doFilter(bodyFile, controlFileList):
+def doFilter(bodyFile, controlFileList, context=None):
     """Remove the Received header if the sender authenticated himself."""
-    authUser = courier.control.getAuthUser(controlFileList, bodyFile)
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
+    authUser = context.getAuthUser()
     if authUser is None:
         return ''
     mfilter = courier.xfilter.XFilter('noreceivedheaders', bodyFile,
@@ -38,12 +38,16 @@ def doFilter(bodyFile, controlFileList):
 
     """
     rcpts = courier.control.getRecipientsData(controlFileList)
+    newrcpts = []
+    oldrcpts = []
     for x in rcpts:
         if 'S' in x[2]:
             newrcpt = x[:]
             newrcpt[2] = ''
-            courier.control.addRecipientData(controlFileList, newrcpt)
-            courier.control.delRecipientData(controlFileList, x)
+            newrcpts.append(newrcpt)
+            oldrcpts.append(x)
+    courier.control.addRecipientsData(controlFileList, newrcpts)
+    courier.control.delRecipientsData(controlFileList, oldrcpts)
     # Return no decision.
     return ''
 
@@ -20,9 +20,11 @@
 import sys
 import re
 import courier.config
-import courier.control
+import courier.context
 
 
+readOnly = True
+
 # private_rcpts is a list of addresses which should only accept
 # mail from listed senders.  The key name should be the private
 # address; the value should be a list of regexes which match
@@ -52,9 +54,11 @@ def initFilter():
     sys.stderr.write('Initialized the "privateaddr" python filter\n')
 
 
-def doFilter(bodyFile, controlFileList):
+def doFilter(bodyFile, controlFileList, context=None):
     """Refuse mail if recipient is private, and sender is not approved."""
-    for addr in courier.control.getRecipientsData(controlFileList):
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
+    for addr in context.getRecipientsData():
         if addr[1]:
             if(addr[1].startswith('rfc822;')):
                 rcpt = addr[1][7:]
@@ -66,7 +70,7 @@ def doFilter(bodyFile, controlFileList):
             rcpt = rcpt.lower()
         if rcpt in private_rcpts:
             senderAllowed = 0
-            sender = courier.control.getSender(controlFileList)
+            sender = context.getSender()
             for pattern in private_rcpts[rcpt]:
                 if _private_re[pattern].match(sender):
                     senderAllowed = 1
@@ -21,7 +21,10 @@ import os
 import sys
 import courier.authdaemon
 import courier.config
-import courier.control
+import courier.context
+
+
+readOnly = True
 
 
 def _parsequota(quota):
@@ -73,9 +76,11 @@ def initFilter():
     sys.stderr.write('Initialized the "quota" python filter\n')
 
 
-def doFilter(bodyFile, controlFileList):
+def doFilter(bodyFile, controlFileList, context=None):
     """Reject mail if any recipient is over quota"""
-    rcpts = courier.control.getRecipientsData(controlFileList)
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
+    rcpts = context.getRecipientsData()
     for x in rcpts:
         (user, domain) = x[0].split('@', 1)
         if courier.config.isLocal(domain):
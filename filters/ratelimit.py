@@ -21,8 +21,8 @@ import ipaddress
 import sys
 import thread
 import time
-import courier.control
 import courier.config
+import courier.context
 
 
 # The rate is measured in messages / interval in minutes
@@ -54,14 +54,16 @@ def initFilter():
     sys.stderr.write('Initialized the ratelimit python filter\n')
 
 
-def doFilter(bodyFile, controlFileList):
+def doFilter(bodyFile, controlFileList, context=None):
     """Track the number of connections from each IP and temporarily fail
     if there have been too many."""
 
     global _sendersLastPurged
 
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
     try:
-        sender = courier.control.getSendersIP(controlFileList)
+        sender = context.getSendersIP()
         # limitNetwork might mangle "sender," so save a copy
         esender = sender
     except:
@@ -17,11 +17,10 @@
 # You should have received a copy of the GNU General Public License
 # along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
 
-import email
 import email.utils
 import sys
 import courier.config
-import courier.control
+import courier.context
 import courier.sendmail
 
 
@@ -34,36 +33,33 @@ def initFilter():
     sys.stderr.write('Initialized the "sentfolder" python filter\n')
 
 
-def doFilter(bodyFile, controlFileList):
-    sender = courier.control.getAuthUser(controlFileList, bodyFile)
+def doFilter(bodyFile, controlFileList, context=None):
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
+    sender = context.getAuthUser()
     if not sender:
         return ''
 
     if '@' not in sender:
         sender = '%s@%s' % (sender, courier.config.me())
-    courier.sendmail.sendmail('', sender, makemsg(bodyFile, controlFileList))
+    courier.sendmail.sendmail('', sender, makemsg(bodyFile, controlFileList, context))
 
     return ''
 
 
-def makemsg(bodyFile, controlFileList):
+def makemsg(bodyFile, controlFileList, context=None):
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
     yield ('X-Deliver-To-Sent-Folder: ' + siteid + '\r\n')
 
-    try:
-        bfStream = open(bodyFile)
-    except:
-        raise InitError('Internal failure opening message data file')
-    try:
-        msg = email.message_from_file(bfStream)
-    except Exception, e:
-        raise InitError('Internal failure parsing message data file: %s' % str(e))
-    tos = msg.get_all('to', [])
-    ccs = msg.get_all('cc', [])
-    resent_tos = msg.get_all('resent-to', [])
-    resent_ccs = msg.get_all('resent-cc', [])
+    msg = context.getHeaders()
+    tos = msg.getAll('to')
+    ccs = msg.getAll('cc')
+    resent_tos = msg.getAll('resent-to')
+    resent_ccs = msg.getAll('resent-cc')
     all_recipients = [x[1] for x in email.utils.getaddresses(tos + ccs + resent_tos + resent_ccs)]
     bccs = []
-    for recipient in courier.control.getRecipientsData(controlFileList):
+    for recipient in context.getRecipientsData():
         if recipient[1]:
             r = recipient[1]
         else:
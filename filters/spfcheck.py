@@ -19,21 +19,37 @@
 # along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
-import courier.control
+import courier.context
+import courier.resolver
 import spf
 
 
+readOnly = True
+
+
 def initFilter():
+    # Use the shared DNS cache for SPF lookups.
+    spf.DNSLookup = courier.resolver.spfDNSLookup
     # Record in the system log that this filter was initialized.
     sys.stderr.write('Initialized the SPF python filter\n')
 
 
-def doFilter(bodyFile, controlFileList):
+def prefetch(context):
+    """Return the DNS lookups that doFilter will make for this message."""
+    sender = context.getSender()
+    if '@' not in sender:
+        return []
+    return [(sender.split('@')[-1], courier.resolver.TXT)]
+
+
+def doFilter(bodyFile, controlFileList, context=None):
     """Use the SPF mechanism to blacklist email."""
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
     try:
-        sendersMta = courier.control.getSendersMta(controlFileList)
-        sendersIp = courier.control.getSendersIP(controlFileList)
-        sender = courier.control.getSender(controlFileList)
+        sendersMta = context.getSendersMta()
+        sendersIp = context.getSendersIP()
+        sender = context.getSender()
     except:
         return '451 Internal failure locating control files'
 
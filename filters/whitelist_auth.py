@@ -17,16 +17,19 @@
 # You should have received a copy of the GNU General Public License
 # along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
 
-import courier.control
+import courier.context
 import sys
 
 
+readOnly = True
+
+
 def initFilter():
     # Record in the system log that this filter was initialized.
     sys.stderr.write('Initialized the "whitelist_auth" python filter\n')
 
 
-def doFilter(bodyFile, controlFileList):
+def doFilter(bodyFile, controlFileList, context=None):
     """Return a 200 code if the sender appears to have authenticated.
 
     Courier does not currently contain this information in its control
@@ -38,7 +41,9 @@ def doFilter(bodyFile, controlFileList):
 
     """
 
-    authUser = courier.control.getAuthUser(controlFileList, bodyFile)
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
+    authUser = context.getAuthUser()
     if authUser:
         return '200 Ok'
     else:
@@ -18,12 +18,20 @@
 # along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
-import socket
-import courier.control
 import courier.config
+import courier.context
+import courier.dnslist
 
 
+readOnly = True
+
+# dnswlZone may be a list of zones, in which case a message is
+# whitelisted if its sender is listed in any of them, or a dictionary
+# mapping zones to weights, as described for courier.dnslist.score.
+# A message is whitelisted if the weights of the lists that include
+# the sender add up to at least dnswlThreshold.
 dnswlZone = ['list.dnswl.org']
+dnswlThreshold = 1
 
 
 def initFilter():
@@ -32,7 +40,12 @@ def initFilter():
     sys.stderr.write('Initialized the "whitelist_dnswl" python filter\n')
 
 
-def doFilter(bodyFile, controlFileList):
+def prefetch(context):
+    """Return the DNS lookups that doFilter will make for this message."""
+    return courier.dnslist.prefetchQueries(context.getSendersIP(), dnswlZone)
+
+
+def doFilter(bodyFile, controlFileList, context=None):
     """Return a 200 code if the message came from an IP in a DNS whitelist.
 
     After returning a 200 code, the pythonfilter process will
@@ -40,25 +53,16 @@ def doFilter(bodyFile, controlFileList):
 
     """
 
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
     try:
-        sendersIP = courier.control.getSendersIP(controlFileList)
+        sendersIP = context.getSendersIP()
     except:
         return '451 Internal failure locating control files'
 
-    if sendersIP and '.' in sendersIP:
-        # '.' must be in sendersIP until there are DNSWLs that support IPv6
-        octets = sendersIP.split('.')
-        octets.reverse()
-        octetsR = '.'.join(octets)
-        for zone in dnswlZone:
-            lookup = '%s.%s' % (octetsR, zone)
-            try:
-                lookupResult = socket.gethostbyname(lookup)
-            except:
-                lookupResult = None
-            if lookupResult:
-                # For now, any result is good enough.
-                return '200 Ok'
+    # All of the zones are queried at the same time.
+    if courier.dnslist.score(sendersIP, dnswlZone) >= dnswlThreshold:
+        return '200 Ok'
 
     # Return no decision for everyone else.
     return ''
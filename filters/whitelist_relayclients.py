@@ -18,8 +18,11 @@
 # along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
-import courier.control
 import courier.config
+import courier.context
+
+
+readOnly = True
 
 
 def initFilter():
@@ -27,7 +30,7 @@ def initFilter():
     sys.stderr.write('Initialized the "whitelist_relayclients" python filter\n')
 
 
-def doFilter(bodyFile, controlFileList):
+def doFilter(bodyFile, controlFileList, context=None):
     """Return a 200 code if the message came from an IP that we relay for.
 
     After returning a 200 code, the pythonfilter process will
@@ -35,8 +38,10 @@ def doFilter(bodyFile, controlFileList):
 
     """
 
+    if context is None:
+        context = courier.context.MessageContext(bodyFile, controlFileList)
     try:
-        sendersIP = courier.control.getSendersIP(controlFileList)
+        sendersIP = context.getSendersIP()
     except:
         return '451 Internal failure locating control files'
 
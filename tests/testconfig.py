@@ -83,6 +83,47 @@ class TestCourierConfig(unittest.TestCase):
         self.assertEqual(courier.config.isLocal('herald.private.dragonsdawn.net'),
                          False)
 
+    def testIsLocalRules(self):
+        courier.config.configCheckInterval = 0
+        try:
+            localsFile = open('tmp/configfiles/locals', 'w')
+            localsFile.write('# comment\n'
+                             '!mail.example.com\n'
+                             '.example.com\n'
+                             'example.net\n')
+            localsFile.close()
+            self.assertEqual(courier.config.isLocal('example.net'), True)
+            self.assertEqual(courier.config.isLocal('www.example.com'), True)
+            self.assertEqual(courier.config.isLocal('mail.example.com'), False)
+            self.assertEqual(courier.config.isLocal('example.com'), False)
+            self.assertEqual(courier.config.isLocal('private.dragonsdawn.net'), False)
+            os.remove('tmp/configfiles/locals')
+            self.assertEqual(courier.config.isLocal('example.net'), False)
+            self.assertEqual(courier.config.isLocal('ascension.private.dragonsdawn.net'),
+                             True)
+        finally:
+            courier.config.configCheckInterval = 5
+
+    def testSetupState(self):
+        savedStateFile = courier.config.setupStateFile
+        savedVersion = courier.config.version
+        courier.config.setupStateFile = 'tmp/courier-config'
+        try:
+            courier.config.version = '0.68.0'
+            courier.config._saveSetupState()
+            courier.config.version = 'unknown'
+            self.assertEqual(courier.config._loadSetupState(), True)
+            self.assertEqual(courier.config.version, '0.68.0')
+            stateFile = open('tmp/courier-config', 'a')
+            stateFile.write('courier=/nonexistent/courier:0\n')
+            stateFile.close()
+            courier.config.version = 'unknown'
+            self.assertEqual(courier.config._loadSetupState(), False)
+            self.assertEqual(courier.config.version, 'unknown')
+        finally:
+            courier.config.setupStateFile = savedStateFile
+            courier.config.version = savedVersion
+
     def testIsHosteddomain(self):
         self.assertEqual(courier.config.isHosteddomain('virtual.private.dragonsdawn.net'),
                          True)
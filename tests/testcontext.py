@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# pythonfilter -- A python framework for Courier global filters
+# Copyright (C) 2008  Gordon Messmer <gordon@dragonsdawn.net>
+#
+# This file is part of pythonfilter.
+#
+# pythonfilter is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pythonfilter is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import unittest
+import courier.config
+
+
+courier.config.sysconfdir = 'tmp/configfiles'
+
+
+import courier.context
+import courier.control
+
+
+class TestCourierContext(unittest.TestCase):
+
+    def setUp(self):
+        os.mkdir('tmp')
+        os.system('cp -a queuefiles tmp/queuefiles')
+        os.system('cp -a configfiles tmp/configfiles')
+        self.context = courier.context.MessageContext('tmp/queuefiles/data-test1',
+                                                      ['tmp/queuefiles/control-duplicate'])
+
+    def tearDown(self):
+        os.system('rm -rf tmp')
+
+    def testValues(self):
+        self.assertEqual(self.context.getSender(),
+                         'root@ascension.private.dragonsdawn.net')
+        self.assertEqual(self.context.getSendersMta(),
+                         'dns; localhost (localhost [127.0.0.1])')
+        self.assertEqual(self.context.getSendersIP(), '127.0.0.1')
+        self.assertEqual(self.context.getRecipients(),
+                         ['gordon@ascension.private.dragonsdawn.net',
+                          'gordon@ascension.private.dragonsdawn.net'])
+        self.assertEqual(self.context.getAuthUser(), None)
+        self.assertEqual(self.context.getHeaders()['Subject'], 'test1')
+
+    def testCopies(self):
+        rcpts = self.context.getRecipientsData()
+        rcpts[0][0] = 'changed'
+        self.assertEqual(self.context.getRecipients()[0],
+                         'gordon@ascension.private.dragonsdawn.net')
+
+    def testInvalidate(self):
+        self.assertEqual(len(self.context.getRecipients()), 2)
+        courier.control.addRecipient(self.context.controlFileList,
+                                     'testcontext@ascension.private.dragonsdawn.net')
+        self.assertEqual(len(self.context.getRecipients()), 2)
+        self.context.invalidate()
+        self.assertEqual(len(self.context.getRecipients()), 3)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCourierContext)
+    unittest.TextTestRunner(verbosity=2).run(suite)
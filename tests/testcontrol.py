@@ -98,6 +98,73 @@ class TestCourierControl(unittest.TestCase):
             self.assertEqual(courier.control.getLines(x['controlFileList'], 'e'),
                              [x['controlData']['e']])
 
+    def testControlFile(self):
+        for x in message.values():
+            courier.control.addRecipientData(x['controlFileList'],
+                                             rcptB)
+            courier.control.delRecipientData(x['controlFileList'],
+                                             rcptB)
+            cf = courier.control.ControlFile(x['controlFileList'][0])
+            self.assertEqual(cf.getLines('s'), [x['controlData']['s']])
+            self.assertEqual(cf.recipients[-1], rcptB)
+            self.assertEqual(cf.recipients[-1].seq, len(cf.recipients) - 1)
+            self.assertTrue(cf.recipients[-1].delivered)
+            self.assertEqual([y for y in cf.recipients if not y.delivered],
+                             x['controlData']['r'])
+            for y in x['controlData']['r']:
+                self.assertEqual(cf.findRecipient(y[0]).address, y[0])
+            self.assertEqual(cf.findRecipient(rcptB[0]), None)
+
+    def testRecipient(self):
+        r = courier.control.Recipient(*rcptB)
+        self.assertEqual(r, rcptB)
+        self.assertEqual(rcptB, r)
+        self.assertFalse(r != rcptB)
+        self.assertNotEqual(r, rcptA)
+        self.assertEqual((r[0], r[-1], r[1:], len(r), list(r)),
+                         (rcptB[0], rcptB[-1], rcptB[1:], 3, rcptB))
+        self.assertEqual(r[:], rcptB)
+        self.assertEqual(type(r[:]), list)
+        r[2] = ''
+        self.assertEqual(r.dsn, '')
+        r[:2] = rcptA[:2]
+        self.assertEqual(r, rcptA)
+        self.assertRaises(IndexError, r.__getitem__, 3)
+        self.assertRaises(ValueError, r.__setitem__, slice(0, 3), ['a'])
+
+    def testMmapScanning(self):
+        bodyFile = 'tmp/queuefiles/data-auth'
+        bfo = open(bodyFile, 'w')
+        bfo.write('Received: from client (client [192.0.2.1])\n'
+                  '  (AUTH: LOGIN testuser, TLS: TLSv1)\n'
+                  '  by %s with ESMTPS\n'
+                  'Subject: auth\n'
+                  '\n'
+                  'Received: by nowhere\n' % courier.control._hostname)
+        bfo.close()
+        expected = {}
+        for x in message.values():
+            for key in 'sfrN':
+                expected[(x['controlFileList'][0], key)] = \
+                    courier.control.getLines(x['controlFileList'], key)
+        authUser = courier.control.getAuthUser([], bodyFile)
+        noAuthUser = courier.control.getAuthUser([], 'tmp/queuefiles/data-test1')
+        courier.control.mmapThreshold = 0
+        try:
+            for x in message.values():
+                for key in 'sfrN':
+                    self.assertEqual(courier.control.getLines(x['controlFileList'], key),
+                                     expected[(x['controlFileList'][0], key)])
+                self.assertEqual(courier.control.getLines(x['controlFileList'], 'r', 1),
+                                 expected[(x['controlFileList'][0], 'r')][:1])
+            self.assertEqual(authUser, 'testuser')
+            self.assertEqual(courier.control.getAuthUser([], bodyFile),
+                             authUser)
+            self.assertEqual(courier.control.getAuthUser([], 'tmp/queuefiles/data-test1'),
+                             noAuthUser)
+        finally:
+            courier.control.mmapThreshold = 1048576
+
     def testGetSendersMta(self):
         for x in message.values():
             self.assertEqual(courier.control.getSendersMta(x['controlFileList']),
@@ -164,6 +231,45 @@ class TestCourierControl(unittest.TestCase):
             self.assertEqual(courier.control.getRecipientsData(x['controlFileList']),
                              x['controlData']['r'])
 
+    def testAddRecipientsData(self):
+        for x in message.values():
+            courier.control.addRecipientsData(x['controlFileList'],
+                                              [rcptA, rcptB])
+            self.assertEqual(courier.control.getRecipientsData(x['controlFileList']),
+                             x['controlData']['r'] + [rcptA, rcptB])
+
+    def testAddRecipientsDataSplit(self):
+        courier.control.maxRecipientsPerFile = 3
+        try:
+            for x in message.values():
+                controlFileList = x['controlFileList'][:]
+                rcpts = [rcptA, rcptB, rcptA, rcptB, rcptA]
+                courier.control.addRecipientsData(controlFileList, rcpts)
+                self.assertEqual(controlFileList[1:],
+                                 ['%s.%d' % (controlFileList[0], i)
+                                  for i in range(1, len(controlFileList))])
+                for cf in controlFileList:
+                    self.assertTrue(len(courier.control.ControlFile(cf).recipients) <= 3)
+                self.assertEqual(courier.control.getLines(controlFileList[1:], 's'),
+                                 [])
+                self.assertEqual(courier.control.getRecipientsData(controlFileList),
+                                 x['controlData']['r'] + rcpts)
+        finally:
+            courier.control.maxRecipientsPerFile = None
+
+    def testDelRecipientsData(self):
+        for x in message.values():
+            courier.control.addRecipientsData(x['controlFileList'],
+                                              [rcptB, rcptA, rcptB])
+            courier.control.delRecipientsData(x['controlFileList'],
+                                              [rcptB, rcptB])
+            self.assertEqual(courier.control.getRecipientsData(x['controlFileList']),
+                             x['controlData']['r'] + [rcptA])
+            courier.control.delRecipients(x['controlFileList'],
+                                          [rcptA[0]])
+            self.assertEqual(courier.control.getRecipientsData(x['controlFileList']),
+                             x['controlData']['r'])
+
 
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestCourierControl)
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# pythonfilter -- A python framework for Courier global filters
+# Copyright (C) 2008  Gordon Messmer <gordon@dragonsdawn.net>
+#
+# This file is part of pythonfilter.
+#
+# pythonfilter is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pythonfilter is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+import unittest
+import courier.dnslist
+import courier.resolver
+from testresolver import DNSServer, zone
+
+
+def listing(*codes):
+    return [(300, socket.inet_aton(x)) for x in codes]
+
+
+zone[('1.2.0.192.bl.example.com', courier.resolver.A)] = listing('127.0.0.2', '127.0.0.4')
+zone[('1.2.0.192.wl.example.com', courier.resolver.A)] = listing('127.0.10.3')
+zone[('1.2.0.192.busy.example.com', courier.resolver.A)] = listing('127.255.255.254')
+zone[('1.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.8.b.d.0.1.0.0.2.bl.example.com',
+      courier.resolver.A)] = listing('127.0.0.2')
+
+
+class TestCourierDnslist(unittest.TestCase):
+
+    def setUp(self):
+        self.server = DNSServer()
+        self.server.start()
+        courier.resolver.port = self.server.port
+        courier.resolver.timeout = 0.5
+        courier.resolver.attempts = 1
+        courier.resolver._resolver[0] = courier.resolver.Resolver(['127.0.0.1'])
+
+    def tearDown(self):
+        courier.resolver._resolver[0] = None
+
+    def testQueryName(self):
+        self.assertEqual(courier.dnslist.queryName('192.0.2.1', 'bl.example.com'),
+                         '1.2.0.192.bl.example.com')
+        self.assertEqual(courier.dnslist.queryName('2001:db8::1', 'bl.example.com'),
+                         '1.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.8.b.d.0.1.0.0.2.bl.example.com')
+
+    def testLookup(self):
+        zones = ['bl.example.com', 'wl.example.com', 'busy.example.com', 'none.example.com']
+        self.assertEqual(courier.dnslist.lookup('192.0.2.1', zones),
+                         {'bl.example.com': ['127.0.0.2', '127.0.0.4'],
+                          'wl.example.com': ['127.0.10.3']})
+        self.assertEqual(len(self.server.queries), 4)
+        # Answers are cached.
+        courier.dnslist.lookup('192.0.2.1', zones)
+        self.assertEqual(len(self.server.queries), 4)
+        self.assertEqual(courier.dnslist.lookup('2001:db8::1', zones).keys(),
+                         ['bl.example.com'])
+        self.assertEqual(courier.dnslist.lookup(None, zones), {})
+
+    def testScore(self):
+        self.assertEqual(courier.dnslist.score('192.0.2.1',
+                                               ['bl.example.com', 'wl.example.com',
+                                                'busy.example.com']), 2)
+        self.assertEqual(courier.dnslist.score('192.0.2.1',
+                                               {'bl.example.com': {'127.0.0.2': 5,
+                                                                   '127.0.0.4': 3},
+                                                'wl.example.com': {'127.0.10.0/24': -2}}), 6)
+        self.assertEqual(courier.dnslist.score('192.0.2.1',
+                                               {'bl.example.com': 2.5,
+                                                'wl.example.com': {'127.0.11.0/24': 1}}), 2.5)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCourierDnslist)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# pythonfilter -- A python framework for Courier global filters
+# Copyright (C) 2008  Gordon Messmer <gordon@dragonsdawn.net>
+#
+# This file is part of pythonfilter.
+#
+# pythonfilter is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pythonfilter is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import courier.headers
+
+
+class TestCourierHeaders(unittest.TestCase):
+
+    def testReadHeaders(self):
+        headers = courier.headers.readHeaders('queuefiles/data-test1')
+        self.assertEqual(headers['subject'], 'test1')
+        self.assertEqual(headers.get('To'),
+                         'testalias@ascension.private.dragonsdawn.net')
+        self.assertEqual(headers.getAll('Received'),
+                         ['from localhost (localhost [127.0.0.1])'
+                          '  (uid 0)'
+                          '  by ascension.private.dragonsdawn.net with local;'
+                          ' Thu, 26 Jul 2007 21:30:01 -0700'
+                          '  id 000AF5D6.46A974C9.00002706'])
+        self.assertEqual(len(headers), 6)
+        self.assertFalse('X-Missing' in headers)
+        self.assertEqual(headers.get('X-Missing'), None)
+        self.assertEqual(headers.getAll('X-Missing'), [])
+
+    def testMultipleValues(self):
+        headers = courier.headers.Headers(['To: a@example.com\r\n',
+                                           'cc: b@example.com,\r\n',
+                                           '\tc@example.com\r\n',
+                                           'CC: d@example.com\r\n'])
+        self.assertTrue('Cc' in headers)
+        self.assertEqual(headers['cc'], 'b@example.com,\tc@example.com')
+        self.assertEqual(headers.getAll('Cc'),
+                         ['b@example.com,\tc@example.com', 'd@example.com'])
+        self.assertEqual(headers.items(),
+                         [('To', 'a@example.com'),
+                          ('cc', 'b@example.com,\tc@example.com'),
+                          ('CC', 'd@example.com')])
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCourierHeaders)
+    unittest.TextTestRunner(verbosity=2).run(suite)
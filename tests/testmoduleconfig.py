@@ -17,6 +17,7 @@
 # You should have received a copy of the GNU General Public License
 # along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import unittest
 import courier.config
 
@@ -93,6 +94,33 @@ class TestModuleConfig(unittest.TestCase):
         self.assertEqual(config['adict']['dict1'], 'dictval1')
         self.assertEqual(config['adict']['dict2'], 'dictval2')
 
+    def testCache(self):
+        courier.config._standardConfigPaths = './tmp-modules.conf'
+        courier.config.configCheckInterval = 0
+        try:
+            configFile = open('tmp-modules.conf', 'w')
+            configFile.write('[test]\nalist = [1, 2]\n')
+            configFile.close()
+            config = courier.config.getModuleConfig('test')
+            self.assertEqual(config['alist'], [1, 2])
+            config['alist'].append(3)
+            self.assertEqual(courier.config.getModuleConfig('test')['alist'], [1, 2])
+            configFile = open('tmp-modules.conf', 'w')
+            configFile.write('[test]\nalist = [1, 2, 3, 4]\n')
+            configFile.close()
+            self.assertEqual(courier.config.getModuleConfig('test')['alist'],
+                             [1, 2, 3, 4])
+            courier.config.configCheckInterval = 60
+            os.remove('tmp-modules.conf')
+            self.assertEqual(courier.config.getModuleConfig('test')['alist'],
+                             [1, 2, 3, 4])
+            courier.config.invalidateModuleConfig()
+            self.assertEqual(courier.config.getModuleConfig('test'), {})
+        finally:
+            courier.config.configCheckInterval = 5
+            if os.path.exists('tmp-modules.conf'):
+                os.remove('tmp-modules.conf')
+
 
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestModuleConfig)
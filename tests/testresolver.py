@@ -0,0 +1,234 @@
+#!/usr/bin/python
+# pythonfilter -- A python framework for Courier global filters
+# Copyright (C) 2008  Gordon Messmer <gordon@dragonsdawn.net>
+#
+# This file is part of pythonfilter.
+#
+# pythonfilter is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pythonfilter is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pythonfilter.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+import struct
+import threading
+import time
+import unittest
+import courier.resolver
+
+
+# Records served by the test server, indexed by (name, type).  Each
+# value is a list of (ttl, rdata) tuples.
+zone = {('mail.example.com', courier.resolver.A): [(300, socket.inet_aton('192.0.2.1'))],
+        ('mail.example.com', courier.resolver.AAAA): [(300, socket.inet_pton(socket.AF_INET6, '2001:db8::1'))],
+        ('example.com', courier.resolver.MX): [(300, '\x00\x14\x04mx20\xc0\x0c'),
+                                               (300, '\x00\x0a\x04mx10\xc0\x0c')],
+        ('example.com', courier.resolver.TXT): [(300, '\x05v=spf\x0c1 -all here.')],
+        ('1.2.0.192.in-addr.arpa', courier.resolver.PTR): [(300, '\x04mail\x07example\x03com\x00')],
+        ('zero.example.com', courier.resolver.A): [(0, socket.inet_aton('192.0.2.2'))]}
+soa = ('\x02ns\xc0\x0c\x0ahostmaster\xc0\x0c' +
+       struct.pack('!IIIII', 1, 3600, 600, 86400, 60))
+
+
+class DNSServer(threading.Thread):
+    """A minimal authoritative name server for the names in "zone"."""
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.queries = []
+        self.addresses = []
+        self.delay = 0
+        self.drop = False
+        # Functions which return a forged reply to a query, which is
+        # sent before the real reply, even if that is dropped.
+        self.forgers = []
+
+    def run(self):
+        while 1:
+            (message, address) = self.sock.recvfrom(512)
+            self.queries.append(message)
+            self.addresses.append(address)
+            for forger in self.forgers:
+                self.sock.sendto(forger(message), address)
+            if self.drop:
+                continue
+            if self.delay:
+                time.sleep(self.delay)
+            self.sock.sendto(self.reply(message), address)
+
+    def reply(self, message):
+        (name, offset) = courier.resolver._decodeName(message, 12)
+        qtype = struct.unpack('!H', message[offset:offset+2])[0]
+        question = message[12:offset+4]
+        records = zone.get((name.lower(), qtype), [])
+        rcode = 0
+        authority = []
+        if not records:
+            if name.endswith('example.com'):
+                # The SOA record's owner is compressed to the question
+                # name, which is good enough for this test.
+                authority = [(3600, courier.resolver.SOA, soa)]
+            if name.startswith('missing'):
+                rcode = 3
+        header = struct.pack('!HHHHHH', struct.unpack('!H', message[:2])[0],
+                             0x8580 | rcode, 1, len(records), len(authority), 0)
+        body = []
+        for (ttl, rdata) in records:
+            body.append(struct.pack('!HHHIH', 0xc00c, qtype, 1, ttl, len(rdata)) + rdata)
+        for (ttl, rtype, rdata) in authority:
+            body.append(struct.pack('!HHHIH', 0xc00c, rtype, 1, ttl, len(rdata)) + rdata)
+        return header + question + ''.join(body)
+
+
+def forgedReply(queryId, name, address):
+    """Return a reply giving address as the A record of name."""
+    question = courier.resolver._encodeName(name) + struct.pack('!HH', courier.resolver.A, 1)
+    return (struct.pack('!HHHHHH', queryId, 0x8580, 1, 1, 0, 0) + question +
+            struct.pack('!HHHIH', 0xc00c, courier.resolver.A, 1, 300, 4) +
+            socket.inet_aton(address))
+
+
+class TestCourierResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.server = DNSServer()
+        self.server.start()
+        courier.resolver.port = self.server.port
+        courier.resolver.timeout = 0.5
+        courier.resolver.attempts = 1
+        self.resolver = courier.resolver.Resolver(['127.0.0.1'])
+
+    def testQueries(self):
+        self.assertEqual(self.resolver.query('mail.example.com', 'A'), ['192.0.2.1'])
+        self.assertEqual(self.resolver.query('Mail.Example.com.', courier.resolver.AAAA),
+                         ['2001:db8::1'])
+        self.assertEqual(sorted(self.resolver.query('example.com', 'MX')),
+                         [(10, 'mx10.example.com'), (20, 'mx20.example.com')])
+        self.assertEqual(self.resolver.query('example.com', 'TXT'),
+                         [('v=spf', '1 -all here.')])
+        self.assertEqual(self.resolver.query(courier.resolver.reverseName('192.0.2.1'), 'PTR'),
+                         ['mail.example.com'])
+        self.assertEqual(courier.resolver.reverseName('2001:db8::1'),
+                         '1.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.8.b.d.0.1.0.0.2.ip6.arpa')
+
+    def testCache(self):
+        self.resolver.query('mail.example.com', 'A')
+        self.resolver.query('mail.example.com', 'A')
+        self.assertEqual(len(self.server.queries), 1)
+        # A TTL of zero is not cached.
+        self.resolver.query('zero.example.com', 'A')
+        self.resolver.query('zero.example.com', 'A')
+        self.assertEqual(len(self.server.queries), 3)
+
+    def testNegativeCache(self):
+        self.assertEqual(self.resolver.query('missing.example.com', 'A'), [])
+        self.assertEqual(self.resolver.query('mail.example.com', 'MX'), [])
+        self.assertEqual(self.resolver.query('missing.example.com', 'A'), [])
+        self.assertEqual(self.resolver.query('mail.example.com', 'MX'), [])
+        self.assertEqual(len(self.server.queries), 2)
+        # Negative answers are cached for the SOA minimum.
+        key = ('missing.example.com', courier.resolver.A)
+        self.assertTrue(self.resolver._cache[key][0] - time.time() <= 60)
+
+    def testInflight(self):
+        self.server.delay = 0.2
+        results = []
+        threads = []
+        for x in range(5):
+            t = threading.Thread(target=lambda: results.append(
+                self.resolver.query('mail.example.com', 'A')))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [['192.0.2.1']] * 5)
+        self.assertEqual(len(self.server.queries), 1)
+
+    def testPrefetch(self):
+        self.server.delay = 0.2
+        self.resolver.prefetch('mail.example.com', 'A')
+        self.resolver.prefetch('mail.example.com', 'A')
+        self.assertEqual(self.resolver.query('mail.example.com', 'A'), ['192.0.2.1'])
+        self.resolver.prefetch('mail.example.com', 'A')
+        self.assertEqual(len(self.server.queries), 1)
+        # Errors are stored for threads that wait for the lookup.
+        self.server.drop = True
+        self.resolver.prefetch('example.com', 'MX')
+        self.assertRaises(courier.resolver.ResolverError,
+                          self.resolver.query, 'example.com', 'MX')
+
+    def testForgedReplies(self):
+        def wrongId(message):
+            queryId = struct.unpack('!H', message[:2])[0]
+            return forgedReply(queryId ^ 1, 'mail.example.com', '192.0.2.66')
+        def wrongQuestion(message):
+            queryId = struct.unpack('!H', message[:2])[0]
+            return forgedReply(queryId, 'other.example.com', '192.0.2.66')
+        def badLength(message):
+            queryId = struct.unpack('!H', message[:2])[0]
+            (name, offset) = courier.resolver._decodeName(message, 12)
+            reply = forgedReply(queryId, name, '192.0.2.66')
+            # An A record with a 3 byte address.
+            return reply[:-6] + struct.pack('!H', 3) + reply[-4:-1]
+        self.server.forgers = [wrongId, wrongQuestion, badLength]
+        self.assertEqual(self.resolver.query('mail.example.com', 'A'), ['192.0.2.1'])
+        self.assertRaises(courier.resolver.ResolverError,
+                          courier.resolver._parseReply,
+                          badLength(courier.resolver._makeQuery(1, 'example.com', 1)))
+        # Forged replies alone are not accepted.
+        self.server.drop = True
+        self.assertRaises(courier.resolver.ResolverError,
+                          self.resolver.query, 'missing.example.com', 'A')
+
+    def testSocketRotation(self):
+        socketQueries = courier.resolver.socketQueries
+        courier.resolver.socketQueries = 2
+        try:
+            for name in ('a', 'b', 'c', 'd', 'e'):
+                self.resolver.query('%s.example.com' % name, 'A')
+        finally:
+            courier.resolver.socketQueries = socketQueries
+        ports = [x[1] for x in self.server.addresses]
+        self.assertEqual(len(set(ports)), 3)
+        self.assertEqual(ports[0], ports[1])
+        self.assertEqual(len(self.resolver._oldSockets) <= 1, True)
+
+    def testPrefetchThreads(self):
+        # Prefetching doesn't start a thread for each lookup.
+        self.server.drop = True
+        threads = threading.activeCount()
+        for x in range(50):
+            self.resolver.prefetch('host%d.example.com' % x, 'A')
+        self.assertTrue(threading.activeCount() <= threads + 1)
+        self.assertRaises(courier.resolver.ResolverError,
+                          self.resolver.query, 'host0.example.com', 'A')
+        self.server.drop = False
+        for x in range(50):
+            self.resolver.prefetch('mail%d.example.com' % x, 'A')
+        self.resolver.prefetch('mail.example.com', 'A')
+        self.assertEqual(self.resolver.query('mail.example.com', 'A'), ['192.0.2.1'])
+        self.assertEqual(self.resolver.query('mail0.example.com', 'A'), [])
+
+    def testTimeout(self):
+        self.server.drop = True
+        start = time.time()
+        self.assertRaises(courier.resolver.ResolverError,
+                          self.resolver.query, 'mail.example.com', 'A')
+        self.assertTrue(time.time() - start < 2)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCourierResolver)
+    unittest.TextTestRunner(verbosity=2).run(suite)
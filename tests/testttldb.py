@@ -31,6 +31,10 @@ class TestTtlDb(unittest.TestCase):
         os.mkdir('tmp/pythonfilter')
 
     def tearDown(self):
+        # Stop purging the dbs that are about to be removed, and close
+        # connections to them.
+        del TtlDb._dbs[:]
+        TtlDb._pools.clear()
         os.system('rm -rf tmp')
 
     def testdbm(self):
@@ -57,6 +61,216 @@ class TestTtlDb(unittest.TestCase):
         self.assertEqual(int(db['name2']), int(value2))
         self.assertEqual(int(db['name2\' -- ']), int(value2))
 
+    def testdbmPurgeSlices(self):
+        courier.config._standardConfigPaths = './configfiles/pythonfilter-modules.conf'
+        db = TtlDb.TtlDb('testTtlDbSlices', 1, 1)
+        db.lock()
+        for x in range(300):
+            db['old%d' % x] = time.time() - 10
+        db['new'] = time.time()
+        db.unlock()
+        # A new instance must find the existing keys before it can
+        # remove them.
+        db = TtlDb.TtlDb('testTtlDbSlices', 1, 1)
+        sliceTime = TtlDb._purgeSliceTime
+        TtlDb._purgeSliceTime = 0
+        try:
+            db.purge()
+            self.assertEqual('old0' in db or 'old299' in db, True)
+            for x in range(10):
+                db.purge()
+        finally:
+            TtlDb._purgeSliceTime = sliceTime
+        self.assertEqual(len([x for x in db.db.keys() if x.startswith('old')]), 0)
+        self.assertEqual('new' in db, True)
+
+    def testdbmCursor(self):
+        courier.config._standardConfigPaths = './configfiles/pythonfilter-modules.conf'
+        class CursorDb(dict):
+            # Provides the cursor methods of a gdbm file, but no keys().
+            def firstkey(self):
+                self.order = sorted(dict.keys(self))
+                return self.nextkey(None)
+            def nextkey(self, key):
+                if key is not None:
+                    self.order.remove(key)
+                if self.order:
+                    return self.order[0]
+                return None
+            def keys(self):
+                raise AssertionError('keys() read the whole db')
+        db = TtlDb.TtlDbDbm('testTtlDbCursor', 1, 1)
+        db.db = CursorDb([('old%d' % x, str(int(time.time()) - 10)) for x in range(300)])
+        db.db['new'] = str(int(time.time()))
+        db._unindexed = db._scanKeys()
+        sliceTime = TtlDb._purgeSliceTime
+        TtlDb._purgeSliceTime = 0
+        try:
+            self.assertEqual(db.purge(), False)
+            self.assertEqual(len(db.db), 301)
+            for x in range(10):
+                db.purge()
+        finally:
+            TtlDb._purgeSliceTime = sliceTime
+        self.assertEqual(dict.keys(db.db), ['new'])
+
+    def testdbmCursorDeleted(self):
+        courier.config._standardConfigPaths = './configfiles/pythonfilter-modules.conf'
+        class BsddbDb(dict):
+            # Like bsddb, the cursor is reopened at the last key that it
+            # returned, and fails if that key has been deleted.
+            def first(self):
+                self.order = sorted(dict.keys(self))
+                self.current = None
+                return self.next()
+            def next(self):
+                if self.current is not None:
+                    if self.current not in self:
+                        raise KeyError(self.current)
+                    self.order.remove(self.current)
+                if not self.order:
+                    raise KeyError('end')
+                self.current = self.order[0]
+                return (self.current, self[self.current])
+            def keys(self):
+                raise AssertionError('keys() read the whole db')
+        db = TtlDb.TtlDbDbm('testTtlDbCursorDeleted', 1, 1)
+        db.db = BsddbDb([('old%03d' % x, str(int(time.time()) - 10)) for x in range(300)])
+        db._unindexed = db._scanKeys()
+        sliceTime = TtlDb._purgeSliceTime
+        TtlDb._purgeSliceTime = 0
+        try:
+            self.assertEqual(db.purge(), False)
+            # Delete the key under the cursor, as another thread might.
+            del db.db[db.db.current]
+            for x in range(10):
+                db.purge()
+        finally:
+            TtlDb._purgeSliceTime = sliceTime
+        self.assertEqual(dict.keys(db.db), [])
+
+    def testsqlite(self):
+        courier.config._standardConfigPaths = './configfiles/pythonfilter-modules.conf'
+        db = TtlDb.TtlDbSQLite('testTtlDb', 10, 0)
+        db.lock()
+        value1 = time.time() - 20
+        db['name1'] = value1
+        db.unlock()
+        self.assertEqual('name1' in db, True)
+        self.assertEqual(int(db['name1']), int(value1))
+        value2 = time.time()
+        db['name2'] = value1
+        db['name2'] = value2
+        db['name2\' -- '] = value2
+        self.assertEqual(int(db['name2']), int(value2))
+        for x in range(25):
+            db['old%d' % x] = value1
+        chunkSize = TtlDb._purgeChunkSize
+        TtlDb._purgeChunkSize = 10
+        try:
+            db.purge()
+        finally:
+            TtlDb._purgeChunkSize = chunkSize
+        self.assertEqual('name1' in db, False)
+        self.assertEqual('old24' in db, False)
+        self.assertEqual('name2' in db, True)
+        self.assertEqual(int(db['name2\' -- ']), int(value2))
+        del db['name2']
+        self.assertEqual(db['name2'], None)
+
+    def testMany(self):
+        courier.config._standardConfigPaths = './configfiles/pythonfilter-modules.conf'
+        batchSize = TtlDb._batchSize
+        TtlDb._batchSize = 3
+        try:
+            for db in (TtlDb.TtlDbDbm('testTtlDbMany', 10, 10),
+                       TtlDb.TtlDbSQLite('testTtlDbMany', 10, 10)):
+                now = int(time.time())
+                db['name0'] = now - 5
+                db.set_many(dict([('name%d' % x, now) for x in range(1, 8)]))
+                db.set_many({'name0': now})
+                self.assertEqual(db.get_many(['name%d' % x for x in range(10)]),
+                                 dict([('name%d' % x, str(now)) for x in range(8)]))
+                self.assertEqual(db.get_many([]), {})
+                db.delete_many(['name%d' % x for x in range(2, 10)])
+                self.assertEqual(db.get_many(['name%d' % x for x in range(10)]),
+                                 {'name0': str(now), 'name1': str(now)})
+        finally:
+            TtlDb._batchSize = batchSize
+        # Old versions of SQLite allow no more than 999 parameters in a
+        # statement, and set_many uses two for each key.
+        db = TtlDb.TtlDbSQLite('testTtlDbMany', 10, 10)
+        self.assertEqual(db._keysPerStatement(1), TtlDb._batchSize)
+        self.assertEqual(db._keysPerStatement(2), 499)
+        now = int(time.time())
+        db.set_many(dict([('many%d' % x, now) for x in range(1200)]))
+        self.assertEqual(len(db.get_many(['many%d' % x for x in range(1200)])), 1200)
+
+    def testPurgeDeferred(self):
+        # pythonfilter starts purging before deferred filters open
+        # their dbs.
+        courier.config._standardConfigPaths = './configfiles/pythonfilter-modules.conf'
+        checkInterval = TtlDb._purgeCheckInterval
+        TtlDb._purgeCheckInterval = 0.1
+        try:
+            TtlDb.startPurging()
+            self.assertEqual(TtlDb._purgePid, None)
+            db = TtlDb.TtlDb('testTtlDbDeferred', 1, 1)
+            self.assertEqual(TtlDb._purgePid, os.getpid())
+            db.lock()
+            db['old'] = time.time() - 10
+            db.unlock()
+            time.sleep(1.5)
+            db.lock()
+            try:
+                self.assertEqual('old' in db, False)
+            finally:
+                db.unlock()
+        finally:
+            # Stop the purge thread.
+            TtlDb._purging = False
+            TtlDb._purgePid = None
+            time.sleep(0.2)
+            TtlDb._purgeCheckInterval = checkInterval
+
+    def testForbidSharing(self):
+        courier.config._standardConfigPaths = './configfiles/pythonfilter-modules.conf'
+        try:
+            db = TtlDb.TtlDb('testTtlDbShared', 10, 10)
+            self.assertRaises(TtlDb.OpenError, TtlDb.forbidSharing)
+            del TtlDb._dbs[:]
+            TtlDb.forbidSharing()
+            self.assertRaises(TtlDb.OpenError, TtlDb.TtlDb,
+                              'testTtlDbShared', 10, 10)
+            db = TtlDb.TtlDbSQLite('testTtlDbShared', 10, 10)
+        finally:
+            TtlDb._workerProcesses = False
+
+    def testPurgeThread(self):
+        courier.config._standardConfigPaths = './configfiles/pythonfilter-modules.conf'
+        checkInterval = TtlDb._purgeCheckInterval
+        TtlDb._purgeCheckInterval = 0.1
+        try:
+            TtlDb.startPurging()
+            db = TtlDb.TtlDb('testTtlDbThread', 1, 1)
+            db.lock()
+            db['old'] = time.time() - 10
+            db['new'] = time.time() + 10
+            db.unlock()
+            time.sleep(1.5)
+            db.lock()
+            try:
+                self.assertEqual('old' in db, False)
+                self.assertEqual('new' in db, True)
+            finally:
+                db.unlock()
+        finally:
+            # Stop the purge thread.
+            TtlDb._purging = False
+            TtlDb._purgePid = None
+            time.sleep(0.2)
+            TtlDb._purgeCheckInterval = checkInterval
+
 
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestTtlDb)